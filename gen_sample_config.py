@@ -6,31 +6,206 @@
 Python 2 or Python 3
 
 See https://www.home-assistant.io/integrations/switch.rest
+
+    gen_sample_config.py [options]
+
+Options (defaults in brackets):
+
+    --houses RANGES     house codes, e.g. A-C,F [A]
+    --units RANGES      unit numbers, e.g. 1-4,9 [1-16]
+    --names FILENAME    JSON mapping of address to name, e.g.
+                        {"A1": "Kitchen", "B": "Upstairs"}, an address
+                        of just a house code is the whole house switch
+    --url URL           x10_rest base URL [http://localhost:1234]
+    --output FILENAME   write YAML to file rather than stdout
+    --aggregated        one REST sensor polling the whole state table
+                        (GET /x10) with template switches on top of it,
+                        instead of one REST switch (and poll) per unit
+    --scan-interval N   seconds between polls of the sensor [30]
+
+With --names only the named addresses are generated unless --units is
+also given.
 """
 
+import json
 import os
 import sys
 
-def gen_sample_config(house_code='A'):
+from x10_rest import parse_house_codes, pop_option
+
+
+default_url = 'http://localhost:1234'
+sensor_name = 'x10_state'  # aggregated config REST sensor
+
+
+def parse_unit_numbers(unit_number_ranges):
+    """Returns list of unit numbers from e.g. "1-4,9" (-> [1, 2, 3, 4, 9])"""
+    result = []
+    for unit_range in unit_number_ranges.replace(' ', '').split(','):
+        if not unit_range:
+            continue
+        if '-' in unit_range:
+            first, last = unit_range.split('-')
+        else:
+            first = last = unit_range
+        for unit_num in range(int(first), int(last) + 1):
+            if not 1 <= unit_num <= 16:
+                raise ValueError('unit number %r not in range 1-16' % unit_num)
+            if unit_num not in result:
+                result.append(unit_num)
+    return result
+
+
+def load_names(filename):
+    """Returns dict of address (e.g. "A1" or "A") to name from JSON file"""
+    names_file = open(filename, 'r')
+    try:
+        names = json.load(names_file)
+    finally:
+        names_file.close()
+    return dict((address.upper(), name) for address, name in names.items())
+
+
+def addresses_from_names(names):
+    """Returns list of (house_code, unit_num) for named addresses, unit_num None for whole house"""
+    addresses = []
+    for address in names:
+        unit_num = None
+        if address[1:]:
+            unit_num = int(address[1:])
+        addresses.append((address[:1], unit_num))
+    return sorted(addresses, key=lambda address: (address[0], address[1] or 0))
+
+
+def switch_addresses(house_codes, unit_numbers):
+    """Returns list of (house_code, unit_num)"""
+    return [(house_code, unit_num) for house_code in house_codes for unit_num in unit_numbers]
+
+
+def switch_name(house_code, unit_num, names=None):
+    address = '%s%s' % (house_code, unit_num or '')
+    if names and address in names:
+        return names[address]
+    if unit_num is None:
+        return '%s - all switches' % house_code
+    return '%s Switch' % address
+
+
+def quote(value):
+    """YAML double quoted string (JSON strings are valid YAML)"""
+    return json.dumps(value)
+
+
+def gen_sample_config(house_codes='A', unit_numbers=None, names=None, base_url=default_url, out=sys.stdout, addresses=None):
+    """One REST switch per unit, each polls x10_rest separately"""
     # So dumb, no templating used
-    print('# Sample entries for configuration.yaml')
-    print('''
-switch:''')
-    for unit_num in range(1, 16+1):
-        print('  - platform: rest')
-        print('    resource: http://localhost:1234/x10/%s/%d' % (house_code, unit_num))
-        print('    name: "%s%d Switch"' % (house_code, unit_num))
+    if addresses is None:
+        addresses = switch_addresses(house_codes, unit_numbers or range(1, 16+1))
+    out.write('# Sample entries for configuration.yaml\n')
+    out.write('''
+switch:
+''')
+    for house_code, unit_num in addresses:
+        out.write('  - platform: rest\n')
+        if unit_num is None:
+            out.write('    resource: %s/x10/%s\n' % (base_url, house_code))
+        else:
+            out.write('    resource: %s/x10/%s/%d\n' % (base_url, house_code, unit_num))
+        out.write('    name: %s\n' % quote(switch_name(house_code, unit_num, names)))
+
+
+def gen_aggregated_config(house_codes='A', unit_numbers=None, names=None, base_url=default_url, out=sys.stdout,
+                          addresses=None, scan_interval=30):
+    """One REST sensor reads every house code with a single GET /x10 per
+    scan_interval, template switches read their state from the sensor
+    attributes (one per house code) and switch via a rest_command"""
+    if addresses is None:
+        addresses = switch_addresses(house_codes, unit_numbers or range(1, 16+1))
+    sensor_house_codes = sorted(set(house_code for house_code, unit_num in addresses))
+    out.write('# Sample entries for configuration.yaml\n')
+    out.write('# One poll of %s/x10 every %d secs for all %d switches\n' % (base_url, scan_interval, len(addresses)))
+    out.write('''
+sensor:
+  - platform: rest
+    name: %s
+    resource: %s/x10
+    scan_interval: %d
+    value_template: "OK"
+    json_attributes:
+''' % (sensor_name, base_url, scan_interval))
+    for house_code in sensor_house_codes:
+        out.write('      - "%s"\n' % house_code)
+    out.write('''
+rest_command:
+  x10_set:
+    url: "%s/x10/{{ address }}"
+    method: POST
+    payload: "{{ state }}"
+
+switch:
+  - platform: template
+    switches:
+''' % base_url)
+    for house_code, unit_num in addresses:
+        if unit_num is None:
+            entity_id = 'x10_%s' % house_code.lower()
+            address = house_code
+            state_key = 'all'
+        else:
+            entity_id = 'x10_%s%d' % (house_code.lower(), unit_num)
+            address = '%s/%d' % (house_code, unit_num)
+            state_key = str(unit_num)
+        out.write('      %s:\n' % entity_id)
+        out.write('        friendly_name: %s\n' % quote(switch_name(house_code, unit_num, names)))
+        out.write('''        value_template: "{{ (state_attr('sensor.%s', '%s') or {}).get('%s') == 'ON' }}"\n''' % (sensor_name, house_code, state_key))
+        for action, state in (('turn_on', 'ON'), ('turn_off', 'OFF')):
+            out.write('''        %s:
+          - service: rest_command.x10_set
+            data:
+              address: "%s"
+              state: "%s"
+          - service: homeassistant.update_entity
+            target:
+              entity_id: sensor.%s
+''' % (action, address, state, sensor_name))
 
 
 def main(argv=None):
     if argv is None:
         argv = sys.argv
 
-    gen_sample_config()
+    argv = argv[:]
+    # The dumbest arg processing...
+    house_codes = parse_house_codes(pop_option(argv, '--houses', 'A'))
+    unit_ranges = pop_option(argv, '--units')
+    names_filename = pop_option(argv, '--names')
+    base_url = pop_option(argv, '--url', default_url).rstrip('/')
+    output_filename = pop_option(argv, '--output')
+    scan_interval = int(pop_option(argv, '--scan-interval', 30))
+    aggregated = '--aggregated' in argv
+
+    names = None
+    addresses = None
+    if names_filename:
+        names = load_names(names_filename)
+        if unit_ranges is None:
+            addresses = addresses_from_names(names)
+    unit_numbers = parse_unit_numbers(unit_ranges or '1-16')
+
+    out = sys.stdout
+    if output_filename:
+        out = open(output_filename, 'w')
+    try:
+        if aggregated:
+            gen_aggregated_config(house_codes, unit_numbers, names, base_url, out, addresses, scan_interval)
+        else:
+            gen_sample_config(house_codes, unit_numbers, names, base_url, out, addresses)
+    finally:
+        if output_filename:
+            out.close()
 
     return 0
 
 
 if __name__ == "__main__":
     sys.exit(main())
-
@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Benchmarks for x10_rest, no X10 hardware needed.
+Python 2 or Python 3
+
+    x10_bench.py micro [iterations]
+    x10_bench.py load [options]
+    x10_bench.py compare [results_file]
+    x10_bench.py startup [runs] [target_secs]
+
+micro - per request cost of x10_rest.simple_app() called directly
+(no sockets, no server) with a stub driver that does nothing.
+
+load - starts x10_rest (with a stub driver) in process on a free port
+and drives a Home Assistant like mix of requests at it over HTTP;
+polling GETs from many REST switches plus bursts of POSTs. Reports
+throughput and p50/p95/p99 latency and appends the results (with the
+x10_rest version) to a results file, default x10_bench_results.jsonl.
+Options (defaults in brackets):
+
+    --switches N            REST switches polling [200]
+    --poll-interval SECS    seconds between polls of each switch [30]
+    --burst-size N          POSTs per burst [10]
+    --burst-interval SECS   seconds between bursts [5]
+    --duration SECS         length of run [30]
+    --clients N             concurrent client connections [16]
+    --workers N             x10_rest worker threads [x10_rest default]
+    --driver-delay SECS     stub driver time per command [0.5]
+    --simulate PROFILE      use x10_sim.SimulatedDriver instead of stub
+                            driver, e.g. pl or "rf,failure_rate=0.01"
+    --label TEXT            free text saved with results
+    --results FILENAME      where to append results
+
+compare - show saved load results side by side, oldest first.
+
+startup - (Linux/Unix) time from launching x10_rest.py (simulated
+controller, systemd style socket activation) until the first GET is
+answered, best of runs [5]. Exits non-zero if above target_secs [1.0].
+"""
+
+import io
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import timeit
+try:
+    import httplib
+except ImportError:
+    # Python 3
+    import http.client as httplib
+try:
+    import Queue as queue
+except ImportError:
+    # Python 3
+    import queue
+
+import x10_rest
+from x10_rest import pop_option, timer
+
+
+default_results_filename = 'x10_bench_results.jsonl'
+
+
+class StubDriver(object):
+    """Stand-in for x10_any drivers, accepts and discards all commands
+    after waiting delay seconds (i.e. emulates a slow controller)"""
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.command_count = 0
+
+    def x10_command(self, house_code, unit_number, state):
+        if self.delay:
+            time.sleep(self.delay)
+        self.command_count += 1
+
+
+def dummy_start_response(status, headers, exc_info=None):
+    pass
+
+
+def make_environ(method, path_info, body=b''):
+    return {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path_info,
+        'QUERY_STRING': '',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+    }
+
+
+micro_cases = [
+    # name, method, path_info, body
+    ('GET unit', 'GET', '/x10/C/4', b''),
+    ('GET house', 'GET', '/x10/C', b''),
+    ('POST unit', 'POST', '/x10/C/4', b'ON'),
+    ('GET bad unit', 'GET', '/x10/C/99', b''),
+]
+
+
+def micro_benchmark(iterations=20000, out=sys.stdout):
+    """Time simple_app() for each of micro_cases, synchronous sends to a
+    StubDriver so only x10_rest overhead is measured.
+    Returns dict of case name to microseconds per request."""
+    x10_rest.x10device = StubDriver()
+    x10_rest.command_queue = None
+    app = x10_rest.simple_app
+    results = {}
+    for name, method, path_info, body in micro_cases:
+        def one_request():
+            for _ in app(make_environ(method, path_info, body), dummy_start_response):
+                pass
+        try:
+            one_request()
+        except Exception as info:
+            out.write('%-14s failed %r\n' % (name, info))
+            continue
+        # best of 3 to reduce noise
+        elapsed = min(timeit.repeat(one_request, number=iterations, repeat=3))
+        results[name] = elapsed / iterations * 1000000
+        out.write('%-14s %8.2f usec/request\n' % (name, results[name]))
+    return results
+
+
+def startup_time(python=sys.executable):
+    """Seconds from launching x10_rest.py until the first GET is answered.
+    The listening socket is created here and passed like systemd socket
+    activation, so the connect succeeds at once and the measurement is
+    how long the request waits for x10_rest to start."""
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.bind(('127.0.0.1', 0))
+    listen_socket.listen(5)
+    port = listen_socket.getsockname()[1]
+    listen_fd = listen_socket.fileno()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'x10_rest.py')
+
+    def pass_listen_socket():
+        # in the child, before exec
+        if listen_fd != 3:
+            os.dup2(listen_fd, 3)
+        elif hasattr(os, 'set_inheritable'):
+            os.set_inheritable(3, True)  # Python 3 sockets are close on exec
+        os.environ['LISTEN_FDS'] = '1'
+        os.environ['LISTEN_PID'] = str(os.getpid())
+
+    start_time = timer()
+    process = subprocess.Popen([python, script, '--simulate', 'rf'], preexec_fn=pass_listen_socket,
+                               close_fds=False, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    try:
+        connection = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+        connection.request('GET', '/x10/A/1')
+        connection.getresponse().read()
+        elapsed = timer() - start_time
+        connection.close()
+    finally:
+        process.terminate()
+        process.wait()
+        process.stdout.close()
+        listen_socket.close()
+    return elapsed
+
+
+def startup_benchmark(runs=5, target=1.0, out=sys.stdout):
+    """Returns True if best startup_time() is within target seconds"""
+    times = [startup_time() for _ in range(runs)]
+    best = min(times)
+    out.write('startup best %.3f secs, worst %.3f secs, target %.3f secs\n' % (best, max(times), target))
+    return best <= target
+
+
+def percentile(sorted_values, percent):
+    """Nearest rank percentile of already sorted values"""
+    if not sorted_values:
+        return None
+    rank = int(round(percent / 100.0 * len(sorted_values) + 0.5)) - 1
+    return sorted_values[max(0, min(rank, len(sorted_values) - 1))]
+
+
+def latency_summary(latencies):
+    latencies = sorted(latencies)
+    return {
+        'count': len(latencies),
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1] if latencies else None,
+    }
+
+
+def start_server(worker_count=None, driver=None):
+    """Start x10_rest in process (background thread) on a free port,
+    returns (httpd, base_url_host, port)"""
+    if worker_count is None:
+        worker_count = x10_rest.default_worker_count
+    x10_rest.x10device = driver or StubDriver()
+    x10_rest.command_queue = x10_rest.CommandQueue(x10_rest.x10device, x10_rest.x10device_lock)
+    httpd = x10_rest.make_x10_server('127.0.0.1', 0, x10_rest.application, worker_count=worker_count)
+    server_thread = threading.Thread(target=httpd.serve_forever, name='bench-server')
+    server_thread.daemon = True
+    server_thread.start()
+    return httpd, '127.0.0.1', httpd.server_port
+
+
+def build_schedule(switches, poll_interval, burst_size, burst_interval, duration, seed=1234):
+    """Returns time ordered list of (start offset seconds, method, path, body).
+    Each switch polls once per poll_interval (start times spread out like
+    Home Assistant), bursts of POSTs for random units every burst_interval."""
+    rand = random.Random(seed)
+    schedule = []
+    for switch_num in range(switches):
+        house_code = x10_rest.house_codes[switch_num // 16 % 16]
+        path = '/x10/%s/%d' % (house_code, switch_num % 16 + 1)
+        offset = rand.uniform(0, poll_interval)
+        while offset < duration:
+            schedule.append((offset, 'GET', path, b''))
+            offset += poll_interval
+    if burst_size and burst_interval:
+        offset = rand.uniform(0, burst_interval)
+        while offset < duration:
+            for _ in range(burst_size):
+                switch_num = rand.randrange(max(switches, 1))
+                house_code = x10_rest.house_codes[switch_num // 16 % 16]
+                path = '/x10/%s/%d' % (house_code, switch_num % 16 + 1)
+                schedule.append((offset, 'POST', path, rand.choice((b'ON', b'OFF'))))
+            offset += burst_interval
+    schedule.sort(key=lambda entry: entry[0])
+    return schedule
+
+
+def load_benchmark(switches=200, poll_interval=30.0, burst_size=10, burst_interval=5.0,
+                   duration=30.0, clients=16, worker_count=None, driver_delay=0.5, simulate=None, out=sys.stdout):
+    """Run schedule from build_schedule() against an in process server,
+    a new connection per request (like Home Assistant REST switches).
+    Returns results dict."""
+    if simulate:
+        import x10_sim
+        driver = x10_sim.parse_simulate_option(simulate)
+    else:
+        driver = StubDriver(driver_delay)
+    httpd, host, port = start_server(worker_count, driver)
+    schedule = build_schedule(switches, poll_interval, burst_size, burst_interval, duration)
+    work = queue.Queue()
+    latencies = {'GET': [], 'POST': []}
+    errors = []
+    lateness = []  # how far behind schedule requests were sent, i.e. client saturation
+
+    def client():
+        while True:
+            item = work.get()
+            if item is None:
+                break
+            scheduled_time, method, path, body = item
+            start_time = timer()
+            lateness.append(max(0, start_time - scheduled_time))
+            try:
+                connection = httplib.HTTPConnection(host, port, timeout=30)
+                connection.request(method, path, body)
+                response = connection.getresponse()
+                response.read()
+                connection.close()
+                if response.status != 200:
+                    errors.append(response.status)
+                    continue
+            except Exception as info:
+                errors.append(repr(info))
+                continue
+            latencies[method].append(timer() - start_time)
+
+    client_threads = []
+    for client_num in range(clients):
+        client_thread = threading.Thread(target=client, name='bench-client-%d' % client_num)
+        client_thread.daemon = True
+        client_thread.start()
+        client_threads.append(client_thread)
+
+    out.write('load: %d requests over %.1f seconds...\n' % (len(schedule), duration))
+    run_start = timer()
+    for offset, method, path, body in schedule:
+        delay = run_start + offset - timer()
+        if delay > 0:
+            time.sleep(delay)
+        work.put((run_start + offset, method, path, body))
+    for client_thread in client_threads:
+        work.put(None)
+    for client_thread in client_threads:
+        client_thread.join()
+    elapsed = timer() - run_start
+    x10_rest.command_queue.join(timeout=60)
+    httpd.shutdown()
+    httpd.server_close()
+
+    completed = len(latencies['GET']) + len(latencies['POST'])
+    results = {
+        'version': x10_rest.version,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'parameters': {
+            'switches': switches, 'poll_interval': poll_interval,
+            'burst_size': burst_size, 'burst_interval': burst_interval,
+            'duration': duration, 'clients': clients,
+            'workers': x10_rest.default_worker_count if worker_count is None else worker_count,
+            'driver_delay': driver_delay,
+            'simulate': simulate,
+        },
+        'requests': len(schedule),
+        'completed': completed,
+        'errors': len(errors),
+        'elapsed': elapsed,
+        'throughput': completed / elapsed,
+        'commands_sent': len(driver.sent) if simulate else driver.command_count,
+        'GET': latency_summary(latencies['GET']),
+        'POST': latency_summary(latencies['POST']),
+        'max_lateness': max(lateness) if lateness else 0,
+    }
+    return results
+
+
+def format_ms(value):
+    if value is None:
+        return '-'
+    return '%.1f' % (value * 1000)
+
+
+def report(results, out=sys.stdout):
+    out.write('x10_rest %s python %s %s\n' % (results['version'], results['python'], results.get('label', '')))
+    out.write('  %d/%d requests completed, %d errors, %.1f requests/sec, %d commands sent\n' % (
+        results['completed'], results['requests'], results['errors'], results['throughput'], results['commands_sent']))
+    for method in ('GET', 'POST'):
+        summary = results[method]
+        out.write('  %-4s n=%-6d p50 %8s ms  p95 %8s ms  p99 %8s ms  max %8s ms\n' % (
+            method, summary['count'], format_ms(summary['p50']), format_ms(summary['p95']),
+            format_ms(summary['p99']), format_ms(summary['max'])))
+    if results['max_lateness'] > 0.1:
+        out.write('  WARNING clients fell %.1f seconds behind schedule, increase --clients\n' % results['max_lateness'])
+
+
+def save_results(results, results_filename=default_results_filename):
+    results_file = open(results_filename, 'a')
+    try:
+        results_file.write(json.dumps(results, sort_keys=True) + '\n')
+    finally:
+        results_file.close()
+
+
+def load_results(results_filename=default_results_filename):
+    results_file = open(results_filename, 'r')
+    try:
+        return [json.loads(line) for line in results_file if line.strip()]
+    finally:
+        results_file.close()
+
+
+def compare(all_results, out=sys.stdout):
+    """Table of saved results, oldest first, to spot regressions"""
+    out.write('%-19s %-8s %-12s %9s %8s %8s %8s %8s %6s\n' % (
+        'timestamp', 'version', 'label', 'req/sec', 'GET p50', 'GET p99', 'POST p50', 'POST p99', 'errors'))
+    for results in all_results:
+        out.write('%-19s %-8s %-12s %9.1f %8s %8s %8s %8s %6d\n' % (
+            results['timestamp'], results['version'], results.get('label', '')[:12], results['throughput'],
+            format_ms(results['GET']['p50']), format_ms(results['GET']['p99']),
+            format_ms(results['POST']['p50']), format_ms(results['POST']['p99']), results['errors']))
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    try:
+        benchmark_name = argv[1]
+    except IndexError:
+        benchmark_name = 'micro'
+
+    if benchmark_name == 'micro':
+        try:
+            iterations = int(argv[2])
+        except IndexError:
+            iterations = 20000
+        micro_benchmark(iterations)
+    elif benchmark_name == 'load':
+        argv = argv[:]
+        results_filename = pop_option(argv, '--results', default_results_filename)
+        label = pop_option(argv, '--label', '')
+        worker_count = pop_option(argv, '--workers')
+        if worker_count is not None:
+            worker_count = int(worker_count)
+        results = load_benchmark(
+            switches=int(pop_option(argv, '--switches', 200)),
+            poll_interval=float(pop_option(argv, '--poll-interval', 30.0)),
+            burst_size=int(pop_option(argv, '--burst-size', 10)),
+            burst_interval=float(pop_option(argv, '--burst-interval', 5.0)),
+            duration=float(pop_option(argv, '--duration', 30.0)),
+            clients=int(pop_option(argv, '--clients', 16)),
+            worker_count=worker_count,
+            driver_delay=float(pop_option(argv, '--driver-delay', 0.5)),
+            simulate=pop_option(argv, '--simulate'),
+        )
+        results['label'] = label
+        report(results)
+        save_results(results, results_filename)
+        print('results appended to %s' % results_filename)
+    elif benchmark_name == 'compare':
+        try:
+            results_filename = argv[2]
+        except IndexError:
+            results_filename = default_results_filename
+        compare(load_results(results_filename))
+    elif benchmark_name == 'startup':
+        runs = int((argv[2:3] or [5])[0])
+        target = float((argv[3:4] or [1.0])[0])
+        if not startup_benchmark(runs, target):
+            sys.stderr.write('startup slower than target\n')
+            return 1
+    else:
+        sys.stderr.write('unknown benchmark %r\n' % benchmark_name)
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -30,10 +30,14 @@ Uses WSGI, see http://docs.python.org/library/wsgiref.html
 """
 
 
+import gzip
+import io
 import logging
 import os
 import sys
 import platform
+import threading
+import zlib
 try:
     # py2 (and <py3.8)
     from cgi import parse_qs
@@ -57,6 +61,14 @@ default_serial_port_name = 'com5'  # Windows serial port
 
 serial_port_name = default_serial_port_name
 
+# One long lived driver for all requests, created on first use
+x10device = None
+x10device_lock = threading.Lock()
+
+# Optional state table (x10_rest.X10StateTable) used to show which units
+# are on, set when mounted in x10_rest.py (see --remote)
+state_table = None
+
 # Hard code http port for web server
 server_port = 8777
 
@@ -71,6 +83,7 @@ body {width:100%;height:100%;}
 .coms {width:100%;}
 .zones {width:100%;}
 table{cellpadding:0px;cellspacing:0px;border:0px;}
+.on {font-weight:bold;background-color:#fd5;}
 </style>
   </head>
   <body>
@@ -211,15 +224,113 @@ def to_bytes(in_str):
     # could choose to only encode for Python 3+
     return in_str.encode('utf-8')
 
-def simple_app(environ, start_response):
-    setup_testing_defaults(environ)
+def render_page(house_code=None, mask=None):
+    """Returns html page (str) with house_code selected and, if mask is
+    given (see x10_rest.X10StateTable.house_mask()), units that are on marked"""
+    page = html
+    if house_code:
+        page = page.replace('>%s<' % house_code, ' checked="checked">%s<' % house_code)
+    if mask is not None:
+        for unit_num in range(1, 17):
+            if mask & (1 << unit_num):
+                page = page.replace('value="ON_%d" class="com"' % unit_num, 'value="ON_%d" class="com on"' % unit_num)
+            else:
+                page = page.replace('value="OFF_%d" class="com"' % unit_num, 'value="OFF_%d" class="com on"' % unit_num)
+    return page
+
+
+def gzip_bytes(data):
+    out = io.BytesIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb', mtime=0)
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
 
-    status = '200 OK'
-    headers = [('Content-type', 'text/html')]
+def encode_page(house_code=None, mask=None):
+    """Returns (body, gzip body, etag) for render_page()"""
+    body = to_bytes(render_page(house_code, mask))
+    etag = '"%08x"' % (zlib.crc32(body) & 0xffffffff)
+    return body, gzip_bytes(body), etag
 
+
+# (house_code, mask) -> encode_page() result, see cached_page()
+page_cache = {}
+page_cache_limit = 256  # beyond the 17 stateless pages, one per house/state seen
+
+
+def prerender_pages():
+    """Encode the pages without unit state, none selected plus one per house code"""
+    for house_code in [None] + list('ABCDEFGHIJKLMNOP'):
+        if (house_code, None) not in page_cache:
+            page_cache[(house_code, None)] = encode_page(house_code)
+
+
+def cached_page(house_code=None, mask=None):
+    """Returns encode_page() result, each page is only rendered once"""
+    key = (house_code, mask)
+    try:
+        return page_cache[key]
+    except KeyError:
+        pass
+    entry = encode_page(house_code, mask)
+    if len(page_cache) >= page_cache_limit:
+        page_cache.clear()
+        prerender_pages()
+    page_cache[key] = entry
+    return entry
+
+
+def page_response(environ, start_response, house_code=None, status='200 OK'):
+    """Serve cached page, gzip if accepted. Pages without state can be
+    cached by the browser, pages showing state are revalidated via ETag"""
+    mask = None
+    if state_table is not None and house_code:
+        mask = state_table.house_mask(house_code)
+    body, gzip_body, etag = cached_page(house_code, mask)
+    headers = [('Content-type', 'text/html'), ('Vary', 'Accept-Encoding')]
+    if state_table is None:
+        headers.append(('Cache-Control', 'max-age=3600'))
+    else:
+        headers.append(('Cache-Control', 'no-cache'))
+    if 'gzip' in environ.get('HTTP_ACCEPT_ENCODING', ''):
+        body = gzip_body
+        etag = etag[:-1] + '-gzip"'
+        headers.append(('Content-Encoding', 'gzip'))
+    headers.append(('ETag', etag))
+    if environ['REQUEST_METHOD'] == 'GET' and environ.get('HTTP_IF_NONE_MATCH') == etag:
+        start_response('304 Not Modified', headers)
+        return []
+    headers.append(('Content-Length', str(len(body))))
     start_response(status, headers)
+    return [body]
+
+
+def send_command(house_code, unit_num, state, client=None):
+    """Send X10 command using shared driver for serial_port_name.
+    Replaced when mounted in x10_rest.py (see --remote) so the remote shares
+    the REST server driver, transmit queue and state table.
+    client is the address of the browser, for x10_rest rate limits."""
+    global x10device
+    with x10device_lock:
+        if x10device is None:
+            x10device = x10_any.FirecrackerDriver(serial_port_name)
+        x10device.x10_command(house_code, unit_num, state)
+
 
-    ret = []
+def parse_command(parameters):
+    """Returns (house_code, unit_num, state) from form parameters,
+    raises x10_any.X10BaseException (or ValueError) on bad input"""
+    house_code = x10_any.normalize_housecode((parameters.get('zone') or [''])[0])
+    state, unit_num = (parameters.get('command') or [''])[0].split('_')
+    unit_num = x10_any.normalize_unitnumber(unit_num)
+    if state not in ('ON', 'OFF'):
+        raise ValueError('unknown command %r' % state)
+    return house_code, unit_num, state
+
+
+def simple_app(environ, start_response):
+    setup_testing_defaults(environ)
 
     if environ['REQUEST_METHOD'] == 'POST':
         body= ''  # b'' for consistency on Python 3.0
@@ -235,37 +346,34 @@ def simple_app(environ, start_response):
             log.info('DEBUG body %r', body)
             parameters = parse_qs(body)
             log.info('DEBUG parameters %r', parameters)
-            house_code = parameters.get('zone')
-            command = parameters.get('command')
-            log.info('DEBUG house_code %r', house_code)
-            log.info('DEBUG command %r', command)
-            if house_code:
-                house_code = house_code[0]
-            if command:
-                command = command[0]
-                if command:
-                    # WARNING no sanity checks input values!
-                    # Assume we have an on/off directive
-                    command = command.split('_')
-                    log.info('DEBUG split command %r', command)
-
-            # Repeat WARNING no sanity checks on input values!
-            unit_num = int(command[1])
-            state = command[0]
-
-            # FIXME
-            dev = x10_any.FirecrackerDriver()
-            #dev = x10_any.FirecrackerDriver(serial_port_name)
-            #dev = x10_any.FirecrackerDriver('COM11')
-            #dev = x10_any.FirecrackerDriver('/dev/ttyUSB0')
-            dev.x10_command(house_code, unit_num, state)
+            try:
+                house_code, unit_num, state = parse_command(parameters)
+            except (x10_any.X10BaseException, ValueError) as info:
+                log.info('bad request %r', info)
+                start_response('400 Bad Request', [('Content-type', 'text/plain')])
+                return [to_bytes('Select a house code and an ON/OFF button\n')]
+            log.info('DEBUG house_code %r unit_num %r state %r', house_code, unit_num, state)
+
+            try:
+                send_command(house_code, unit_num, state, environ.get('REMOTE_ADDR'))
+            except x10_any.X10BaseException as info:
+                log.warning('send failed %r', info)
+                # x10_rest rejections (e.g. rate limit 429) carry their own status
+                start_response(getattr(info, 'status', '503 Service Unavailable'), [('Content-type', 'text/plain')])
+                return [to_bytes('Not sent, %s. Try again later\n' % info)]
 
             # Preserve which house code/zone was selected
-            ret.append(to_bytes(html.replace('>%s<' % house_code, ' checked="checked">%s<' % house_code)))
-    else:
-        ret.append(to_bytes(html))
+            return page_response(environ, start_response, house_code)
+        return page_response(environ, start_response)
 
-    return ret
+    # GET, optional ?zone=C to select (and show state of) a house code
+    house_code = (parse_qs(environ.get('QUERY_STRING', '')).get('zone') or [None])[0]
+    if house_code is not None:
+        try:
+            house_code = x10_any.normalize_housecode(house_code)
+        except x10_any.X10BaseException:
+            house_code = None
+    return page_response(environ, start_response, house_code)
 
 
 def main(argv=None):
@@ -302,6 +410,7 @@ def main(argv=None):
             log.info('Serial port picked up from env X10_SERIAL_PORT')
 
     log.info('Using serial port %r', serial_port_name)
+    prerender_pages()
 
     httpd = make_server('', server_port, simple_app)
     log.info('Serving on http://%s:%d/' % (platform.node(), server_port))
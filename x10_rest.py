@@ -35,24 +35,54 @@ Examples:
   * ...
 """
 
-import cgi
+import array
+import bisect
+import collections
+import cProfile
+import json
 import logging
-import mimetypes
+import mmap
 import os
 import platform
-from pprint import pprint
+import pstats
+import re
+import select
 import socket
+import struct
 try:
     import SocketServer
 except ImportError:
     # Python 3
     import socketserver as SocketServer
 import sys
-from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+import threading
+import time
+try:
+    from cStringIO import StringIO
+except ImportError:
+    # Python 3
+    from io import StringIO
+try:
+    from urlparse import parse_qs
+except ImportError:
+    # Python 3
+    from urllib.parse import parse_qs
+try:
+    import Queue as queue
+except ImportError:
+    # Python 3
+    import queue
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler
 
 import x10_any
 from x10_any import OFF, ON, ALL_OFF, LAMPS_OFF, LAMPS_ON
 
+try:
+    basestring
+except NameError:
+    # Python 3
+    basestring = str
+
 
 version_tuple = (0, 0, 3)
 version = version_string = __version__ = '%d.%d.%d' % version_tuple
@@ -61,11 +91,16 @@ logging.basicConfig()
 default_logger = logging.getLogger(__name__)
 
 http_server_port = 1234
+default_keep_alive_timeout = 15  # seconds an idle persistent connection is kept open
+default_max_keep_alive_requests = 100  # requests per persistent connection
+default_worker_count = 8  # 0 means single threaded, i.e. original wsgiref behavior
+default_coalesce_window = 0.1  # seconds a command waits in the queue for a superseding command
 
-# TODO allow config for three items below
+# Defaults, override via command line or environment, see main()
 mochad_host = 'localhost'
 mochad_port = 1099
 mochad_type = 'rf'  # or 'pl'
+mochad_timeout = 5.0  # seconds, for each connect and send
 
 
 def to_bytes(in_str):
@@ -78,6 +113,118 @@ def to_string(in_str):
     # could simple use latin1
     return in_str.decode('utf-8')
 
+class PersistentMochadDriver(x10_any.MochadDriver):
+    """X10 command driver for Mochad (or compatible) server that keeps
+    the connection open between commands, unlike x10_any.MochadDriver
+    which connects (and waits for the close) for each command.
+
+    Connect and send are bounded by timeout. On failure the connection
+    is re-established and the command retried, up to retries times, with
+    an exponential backoff (reset on success) between connection attempts
+    so a restarting mochad is not hammered. Worst case command latency is
+    therefore roughly (retries + 1) * timeout + the backoff delays.
+    """
+
+    def __init__(self, device_address=None, default_type=None, timeout=mochad_timeout, retries=2, backoff=0.1, max_backoff=5.0, log=None):
+        x10_any.MochadDriver.__init__(self, device_address, default_type)
+        self.timeout = timeout
+        self.retries = retries
+        self.initial_backoff = backoff
+        self.max_backoff = max_backoff
+        self.backoff = 0
+        self.log = log or default_logger
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.backoff:
+            time.sleep(self.backoff)
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+        else:
+            self.backoff = self.initial_backoff
+        self.log.debug('Trying connection to: %r', self.device_address)
+        self.sock = socket.create_connection(self.device_address, self.timeout)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.log.info('Connected to mochad %r', self.device_address)
+
+    def disconnect(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+    def close(self):
+        self.disconnect()
+        x10_any.MochadDriver.close(self)
+
+    def discard_received(self):
+        """Mochad sends received/transmitted events to all clients,
+        throw them away so they do not back up.
+        Raises socket.error if mochad closed the connection."""
+        while select.select([self.sock], [], [], 0)[0]:
+            if not self.sock.recv(4096):
+                raise socket.error('connection closed by mochad')
+
+    def _x10_command(self, house_code, unit_number, state):
+        """Real implementation"""
+        if state.startswith('xdim') or state.startswith('dim') or state.startswith('bright'):
+            raise NotImplementedError('xdim/dim/bright %r' % ((house_code, unit_number, state), ))
+
+        if unit_number is not None:
+            house_and_unit = '%s%d' % (house_code, unit_number)
+        else:
+            house_and_unit = house_code  # e.g. all_units_off
+        mochad_cmd = self.default_type + b' ' + to_bytes(house_and_unit) + b' ' + to_bytes(state) + b'\n'
+
+        with self.lock:
+            attempt = 0
+            while True:
+                try:
+                    if self.sock is None:
+                        self.connect()
+                    else:
+                        self.discard_received()
+                    self.log.debug('mochad send: %r', mochad_cmd)
+                    self.sock.sendall(mochad_cmd)
+                    self.backoff = 0
+                    return
+                except (socket.error, socket.timeout) as info:
+                    self.log.warning('mochad %r error %r (attempt %d)', self.device_address, info, attempt + 1)
+                    self.disconnect()
+                    attempt += 1
+                    if attempt > self.retries:
+                        raise
+
+
+class LazyDriver(object):
+    """Creates driver on first command rather than at start up, e.g.
+    x10_any.FirecrackerDriver() guesses the serial port when not given.
+    So the server accepts connections immediately, if creation fails the
+    command fails and creation is retried on the next command.
+    """
+
+    def __init__(self, factory, device_address=None, log=None):
+        """@param factory - callable returning a driver
+        @param device_address - for logging, e.g. serial port name"""
+        self.factory = factory
+        self.device_address = device_address
+        self.log = log or default_logger
+        self.lock = threading.Lock()
+        self.device = None
+
+    def x10_command(self, house_code, unit_number, state):
+        device = self.device
+        if device is None:
+            with self.lock:
+                if self.device is None:
+                    self.device = self.factory()
+                    self.log.info('Opened controller %r', self.device)
+                device = self.device
+        device.x10_command(house_code, unit_number, state)
+
+
 def not_found(environ, start_response):
     """serves 404s."""
     start_response('404 NOT FOUND', [('Content-Type', 'text/html')])
@@ -90,96 +237,1933 @@ def not_found(environ, start_response):
 </body></html>''')]
 
 
-x10_status = {}
+def bad_request(environ, start_response, message='Bad Request'):
+    """serves 400s."""
+    start_response('400 BAD REQUEST', [('Content-Type', 'text/plain')])
+    return [to_bytes(message)]
+
+
+def method_not_allowed(environ, start_response, allowed=('GET', 'POST')):
+    """serves 405s."""
+    start_response('405 METHOD NOT ALLOWED', [('Content-Type', 'text/plain'), ('Allow', ', '.join(allowed))])
+    return [to_bytes('Method Not Allowed')]
+
+
+def command_rejected(environ, start_response, info):
+    """serves 503s/429s for CommandRejected exception"""
+    headers = [('Content-Type', 'text/plain')]
+    if info.retry_after is not None:
+        headers.append(('Retry-After', str(int(info.retry_after + 0.999))))
+    start_response(info.status, headers)
+    return [to_bytes(str(info))]
+
+
+house_codes = 'ABCDEFGHIJKLMNOP'
+
+
+class X10StateTable(object):
+    """ON/OFF state for the (fixed size) X10 address space.
+
+    One bitmap per house code, bit 0 is the whole house (see
+    /x10/{house code}) and bits 1-16 are the unit numbers.
+    Whole house commands are a single store, a snapshot is two small
+    array copies. Each house has a version, incremented on every change,
+    for cheap change detection.
+
+    Readers do not lock, writers are serialized with self.lock.
+    """
+
+    house_count = len(house_codes)
+    whole_house_bit = 1
+    all_bits = 0x1FFFF  # whole house plus units 1-16
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.masks = array.array('L', [0] * self.house_count)
+        self.versions = array.array('L', [0] * self.house_count)
+        self.version = 0  # total of all changes
+        self.changed = threading.Condition(self.lock)
+        self.listeners = []
+
+    def add_listener(self, callback):
+        """callback(house_index, mask) is called on each change, whilst
+        self.lock is held so should be quick (e.g. put on a queue)"""
+        self.listeners.append(callback)
+
+    @staticmethod
+    def house_index(house_code):
+        return ord(house_code) - ord('A')
+
+    @staticmethod
+    def unit_bit(unit_num):
+        """unit_num None means whole house"""
+        return 1 << (unit_num or 0)
+
+    def get(self, house_code, unit_num):
+        """Returns ON or OFF"""
+        if self.masks[self.house_index(house_code)] & self.unit_bit(unit_num):
+            return ON
+        return OFF
+
+    def house_mask(self, house_code):
+        return self.masks[self.house_index(house_code)]
+
+    def house_version(self, house_code):
+        return self.versions[self.house_index(house_code)]
+
+    def set(self, house_code, unit_num, state):
+        """Apply normalized command (see normalize_command()) to state"""
+        self.set_many([(house_code, unit_num, state)])
+
+    def set_many(self, commands):
+        with self.lock:
+            for house_code, unit_num, state in commands:
+                house_index = self.house_index(house_code)
+                old_mask = self.masks[house_index]
+                mask = self.apply_command(old_mask, unit_num, state)
+                if mask != old_mask:
+                    self.set_house_mask(house_index, mask)
+
+    @classmethod
+    def apply_command(cls, mask, unit_num, state):
+        """Returns house mask after normalized command"""
+        if state == LAMPS_ON:
+            return cls.all_bits
+        elif state in (ALL_OFF, LAMPS_OFF):
+            return 0
+        elif state.upper() == ON:
+            return mask | cls.unit_bit(unit_num)
+        return mask & ~cls.unit_bit(unit_num)
+
+    def revert(self, house_code, unit_num, state, previous, keep_bits=0):
+        """Undo normalized command that was never sent, previous is the
+        house mask before it. Only bits still as the command left them are
+        restored (i.e. not changed since, e.g. by a mochad event), keep_bits
+        are left alone (e.g. units with newer commands waiting)"""
+        with self.lock:
+            house_index = self.house_index(house_code)
+            mask = self.masks[house_index]
+            if unit_num is None:
+                bits = self.all_bits
+            else:
+                bits = self.unit_bit(unit_num)
+            bits &= ~keep_bits & ~(mask ^ self.apply_command(previous, unit_num, state))
+            new_mask = (mask & ~bits) | (previous & bits)
+            if new_mask != mask:
+                self.set_house_mask(house_index, new_mask)
+
+    def set_house_mask(self, house_index, mask):
+        """caller is expected to hold self.lock"""
+        self.masks[house_index] = mask
+        self.versions[house_index] += 1
+        self.version += 1
+        self.changed.notify_all()
+        for callback in self.listeners:
+            callback(house_index, mask)
+
+    def wait_for_change(self, version, timeout=None):
+        """Wait (up to timeout seconds) until self.version is not version,
+        returns current version"""
+        with self.lock:
+            if self.version == version:
+                self.changed.wait(timeout)
+            return self.version
+
+    def snapshot(self):
+        """Returns (masks, versions) copies, consistent with each other"""
+        with self.lock:
+            return self.masks[:], self.versions[:]
+
+    def versioned_snapshot(self):
+        """Returns (version, masks) consistent with each other"""
+        with self.lock:
+            return self.version, self.masks[:]
+
+    @classmethod
+    def mask_as_dict(cls, mask):
+        """Returns state of whole house as dict suitable for JSON,
+        unit numbers as string keys and 'all' for whole house"""
+        result = {'all': ON if mask & cls.whole_house_bit else OFF}
+        for unit_num in range(1, 16+1):
+            result[str(unit_num)] = ON if mask & (1 << unit_num) else OFF
+        return result
+
+    def house_as_dict(self, house_code):
+        return self.mask_as_dict(self.house_mask(house_code))
+
+    def as_dict(self, masks=None):
+        """Returns state of all house codes, see mask_as_dict()"""
+        if masks is None:
+            masks = self.snapshot()[0]
+        result = {}
+        for house_index, house_code in enumerate(house_codes):
+            result[house_code] = self.mask_as_dict(masks[house_index])
+        return result
+
+
+class SharedArray(object):
+    """Fixed size array of unsigned 64 bit integers in a buffer (mmap),
+    supports what X10StateTable needs of array.array"""
+
+    item_format = '<Q'
+    item_size = 8
+
+    def __init__(self, buf, offset, count):
+        self.buf = buf
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(struct.unpack_from('<%dQ' % self.count, self.buf, self.offset))[index]
+        if not 0 <= index < self.count:
+            raise IndexError('SharedArray index out of range')
+        return struct.unpack_from(self.item_format, self.buf, self.offset + index * self.item_size)[0]
+
+    def __setitem__(self, index, value):
+        if not 0 <= index < self.count:
+            raise IndexError('SharedArray index out of range')
+        struct.pack_into(self.item_format, self.buf, self.offset + index * self.item_size, value)
+
+
+class SharedStateTable(X10StateTable):
+    """X10StateTable in a memory mapped file, shared between processes,
+    see use_driver_owner(). Only the driver owner process writes (and
+    creates the file if needed), other processes map it read only.
+
+    Layout: 8 byte magic, total version, 16 masks, 16 versions (all
+    unsigned 64 bit little endian). An existing file is reused, so
+    versions (ETags) keep increasing across driver owner restarts.
+    Changes made by other processes are seen by polling, see wait_for_change().
+    """
+
+    magic = b'X10STAT1'
+    version_offset = 8
+    masks_offset = 16
+    versions_offset = masks_offset + X10StateTable.house_count * SharedArray.item_size
+    size = versions_offset + X10StateTable.house_count * SharedArray.item_size
+    poll_interval = 0.1  # seconds
+
+    def __init__(self, filename, writable=False):
+        self.filename = filename
+        self.writable = writable
+        if writable:
+            if not os.path.exists(filename) or os.path.getsize(filename) != self.size:
+                state_file = open(filename, 'wb')
+                try:
+                    state_file.write(self.magic + b'\0' * (self.size - len(self.magic)))
+                finally:
+                    state_file.close()
+            state_file = open(filename, 'r+b')
+            access = mmap.ACCESS_WRITE
+        else:
+            state_file = open(filename, 'rb')
+            access = mmap.ACCESS_READ
+        try:
+            self.buf = mmap.mmap(state_file.fileno(), self.size, access=access)
+        finally:
+            state_file.close()  # mapping stays valid
+        if self.buf[:len(self.magic)] != self.magic:
+            raise ValueError('%r is not an x10_rest shared state file' % filename)
+        self.lock = threading.Lock()
+        self.masks = SharedArray(self.buf, self.masks_offset, self.house_count)
+        self.versions = SharedArray(self.buf, self.versions_offset, self.house_count)
+        self.changed = threading.Condition(self.lock)
+        self.listeners = []
+
+    def etag_prefix(self):
+        """ETag prefix (see make_etag()) the same in every process using
+        this file, versions are not reset unless the file is recreated"""
+        return '"%x-' % os.stat(self.filename).st_ino
+
+    @property
+    def version(self):
+        return struct.unpack_from('<Q', self.buf, self.version_offset)[0]
+
+    @version.setter
+    def version(self, value):
+        struct.pack_into('<Q', self.buf, self.version_offset, value)
+
+    def wait_for_change(self, version, timeout=None):
+        """Like X10StateTable.wait_for_change() but polls, as changes may be
+        made by another process"""
+        if self.writable:
+            return X10StateTable.wait_for_change(self, version, timeout)
+        end_time = time.time() + (timeout or 0)
+        while self.version == version and (timeout is None or time.time() < end_time):
+            time.sleep(self.poll_interval)
+        return self.version
+
+
+class StateJournal(object):
+    """Append only journal of X10StateTable changes, so (emulated) state
+    survives a restart.
+
+    Each line is a house code and its mask in hex, e.g. "C 1e", the last
+    line for a house wins. Lines are written by a background thread (not
+    during the request) and the file is periodically compacted, i.e.
+    rewritten as one line per house code and renamed over the journal.
+    """
+
+    def __init__(self, filename, compact_every=1000, log=None):
+        self.filename = filename
+        self.compact_every = compact_every
+        self.log = log or default_logger
+        self.changes = queue.Queue()
+        self.masks = [0] * len(house_codes)  # as last written
+        self.record_count = 0
+        self.journal_file = None
+        self.thread = None
+
+    def load(self, state_table):
+        """Replay journal into state_table, call before start()"""
+        try:
+            journal_file = open(self.filename, 'r')
+        except IOError:
+            self.log.info('No state journal %r, starting with everything OFF', self.filename)
+            return
+        try:
+            for line in journal_file:
+                try:
+                    house_code, mask = line.split()
+                    house_index = house_codes.index(house_code)
+                    mask = int(mask, 16) & X10StateTable.all_bits
+                except ValueError:
+                    # e.g. partial last line after a crash
+                    self.log.warning('Ignoring bad state journal line %r', line)
+                    continue
+                self.masks[house_index] = mask
+                self.record_count += 1
+        finally:
+            journal_file.close()
+        with state_table.lock:
+            for house_index, mask in enumerate(self.masks):
+                state_table.set_house_mask(house_index, mask)
+        self.log.info('Restored state from %r (%d records)', self.filename, self.record_count)
+
+    def start(self, state_table):
+        """Compact journal and record all future changes to state_table"""
+        self.compact()
+        state_table.add_listener(self.record)
+        self.thread = threading.Thread(target=self.run, name='x10-journal')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, house_index, mask):
+        self.changes.put((house_index, mask))
+
+    def compact(self):
+        if self.journal_file is not None:
+            self.journal_file.close()
+        temp_filename = self.filename + '.tmp'
+        temp_file = open(temp_filename, 'w')
+        for house_index, mask in enumerate(self.masks):
+            if mask:
+                temp_file.write('%s %x\n' % (house_codes[house_index], mask))
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+        temp_file.close()
+        try:
+            os.rename(temp_filename, self.filename)
+        except OSError:
+            # Windows will not rename over an existing file
+            os.remove(self.filename)
+            os.rename(temp_filename, self.filename)
+        self.record_count = 0
+        self.journal_file = open(self.filename, 'a')
+
+    def run(self):
+        while True:
+            change = self.changes.get()
+            if change is None:
+                break
+            # write everything that is waiting as one batch
+            changes = [change]
+            try:
+                while True:
+                    changes.append(self.changes.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                for change in changes:
+                    if change is None:
+                        # not expecting more, write what we have
+                        self.changes.put(None)
+                        break
+                    house_index, mask = change
+                    self.masks[house_index] = mask
+                    self.journal_file.write('%s %x\n' % (house_codes[house_index], mask))
+                    self.record_count += 1
+                self.journal_file.flush()
+                if self.record_count >= self.compact_every:
+                    self.compact()
+            except (IOError, OSError):
+                self.log.exception('Failed to write state journal %r', self.filename)
+
+    def close(self):
+        if self.thread is not None:
+            self.changes.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.journal_file is not None:
+            self.journal_file.close()
+            self.journal_file = None
+
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    # Python 2
+    timer = time.time
+
+
+class Counter(object):
+    """Prometheus style counter, optionally with labels"""
+
+    metric_type = 'counter'
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.lock = threading.Lock()
+        self.values = {}  # tuple of label values -> value
+
+    def inc(self, label_values=(), amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    @staticmethod
+    def escape_label_value(value):
+        """Prometheus text format label value escaping"""
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def format_labels(self, label_values, extra=''):
+        labels = ['%s="%s"' % (name, self.escape_label_value(value)) for name, value in zip(self.label_names, label_values)]
+        if extra:
+            labels.append(extra)
+        if not labels:
+            return ''
+        return '{%s}' % ','.join(labels)
+
+    def samples(self):
+        """Returns list of (name suffix, labels string, value)"""
+        with self.lock:
+            values = sorted(self.values.items())
+        return [('', self.format_labels(label_values), value) for label_values, value in values]
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s %s' % (self.name, self.metric_type)]
+        for suffix, labels, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, labels, value))
+        return '\n'.join(lines)
+
+
+class Gauge(Counter):
+    """Prometheus style gauge, either inc() (with negative amounts)
+    or value read on demand from callback()"""
+
+    metric_type = 'gauge'
+
+    def __init__(self, name, help_text, callback=None):
+        Counter.__init__(self, name, help_text)
+        self.callback = callback
+
+    def samples(self):
+        if self.callback is None:
+            return Counter.samples(self)
+        return [('', '', self.callback())]
+
+
+class Histogram(Counter):
+    """Prometheus style histogram, optionally with labels"""
+
+    metric_type = 'histogram'
+    default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, help_text, label_names=(), buckets=default_buckets):
+        Counter.__init__(self, name, help_text, label_names)
+        self.buckets = buckets
+
+    def observe(self, value, label_values=()):
+        bucket_index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                # one count per bucket plus +Inf, then sum of values
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bucket_index] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = sorted((label_values, counts[:]) for label_values, counts in self.values.items())
+        result = []
+        for label_values, counts in values:
+            cumulative = 0
+            for bucket, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                result.append(('_bucket', self.format_labels(label_values, 'le="%s"' % bucket), cumulative))
+            result.append(('_sum', self.format_labels(label_values), counts[-1]))
+            result.append(('_count', self.format_labels(label_values), cumulative))
+        return result
+
+
+http_request_duration = Histogram('x10_http_request_duration_seconds', 'HTTP request latency (until response body returned)', ('method', 'status'))
+http_requests_in_progress = Gauge('x10_http_requests_in_progress', 'HTTP requests being handled')
+driver_command_duration = Histogram('x10_driver_command_duration_seconds', 'Time taken by controller x10_command()', ('house_code',))
+driver_errors = Counter('x10_driver_errors_total', 'Failed controller x10_command() calls', ('house_code',))
+metrics = [http_request_duration, http_requests_in_progress, driver_command_duration, driver_errors]
+
+
+def timed_x10_command(device, house_code, unit_num, state):
+    """device.x10_command() recording driver metrics"""
+    start_time = timer()
+    try:
+        device.x10_command(house_code, unit_num, state)
+    except Exception:
+        driver_errors.inc((house_code,))
+        raise
+    finally:
+        driver_command_duration.observe(timer() - start_time, (house_code,))
+
+
+# Request tracing, see trace_middleware()
+trace_enabled = False
+trace_local = threading.local()  # .spans dict of span name to seconds for current request
+
+
+def add_span(name, start_time):
+    """Add time since start_time to span name of current request trace"""
+    spans = getattr(trace_local, 'spans', None)
+    if spans is not None:
+        spans[name] = spans.get(name, 0) + timer() - start_time
+
+
+mochad_events = Counter('x10_mochad_events_total', 'X10 events applied from mochad', ('direction', 'medium'))
+metrics.append(mochad_events)
+
+
+class MochadEventReader(object):
+    """Keeps state_table in sync with X10 traffic seen by mochad.
+
+    Mochad sends every received (Rx) and transmitted (Tx) X10 command to
+    all connected clients, for example:
+
+        05/22 18:35:45 Tx PL HouseUnit: A1
+        05/22 18:35:45 Tx PL House: A Func: On
+        05/22 18:35:56 Rx RF HouseUnit: A2 Func: Off
+
+    Powerline (PL) addresses units first, the following function applies
+    to all units addressed in that house. A background thread reads
+    events on its own connection (reconnecting with backoff) and applies
+    them to state_table, e.g. when a physical remote is used.
+    """
+
+    event_regex = re.compile(r'\s(Rx|Tx)\s+(PL|RF)\s+(?:HouseUnit:\s+([A-P])(\d+)|House:\s+([A-P]))(?:\s+Func:\s+(.+?))?\s*$')
+    functions = {
+        # mochad function name (lower case) -> state
+        'on': ON,
+        'off': OFF,
+        'all units off': ALL_OFF,
+        'all lights on': LAMPS_ON,
+        'all lights off': LAMPS_OFF,
+    }
+
+    def __init__(self, device_address, state_table, read_timeout=60.0, max_backoff=60.0, pending=None, log=None):
+        """@param pending - optional callable(house_code, unit_num), True if
+            a command for it is waiting to be sent, see command_pending()"""
+        self.device_address = device_address
+        self.state_table = state_table
+        self.pending = pending
+        self.read_timeout = read_timeout  # only to notice dead connections
+        self.max_backoff = max_backoff
+        self.log = log or default_logger
+        self.addressed = {}  # house code -> set of unit numbers (PL)
+        self.function_seen = {}  # house code -> function seen since last address
+        self.running = True
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='mochad-events')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def parse_line(self, line):
+        """Returns list of (house_code, unit_num, state) commands from event line"""
+        match = self.event_regex.search(line)
+        if match is None:
+            return []  # e.g. RFSEC or something not X10 on/off
+        direction, medium, house_code, unit_num, house_only, function = match.groups()
+        commands = []
+        if house_code:
+            unit_num = int(unit_num)
+            if not 1 <= unit_num <= 16:
+                return []
+            if function is None:
+                # PL address, function follows on another line.
+                # Units stay addressed until an address follows a function
+                if self.function_seen.get(house_code, True):
+                    self.addressed[house_code] = set()
+                    self.function_seen[house_code] = False
+                self.addressed[house_code].add(unit_num)
+                return []
+            units = [unit_num]
+        else:
+            house_code = house_only
+            units = self.addressed.get(house_code)
+            self.function_seen[house_code] = True
+        state = self.functions.get((function or '').lower())
+        if state is None:
+            return []  # e.g. Dim/Bright, leave as-is
+        if state in (ALL_OFF, LAMPS_ON, LAMPS_OFF):
+            commands.append((house_code, None, state))
+        elif units:
+            for unit_num in sorted(units):
+                commands.append((house_code, unit_num, state))
+        if commands:
+            mochad_events.inc((direction, medium))
+        return commands
+
+    def run(self):
+        log = self.log
+        backoff = 1.0
+        while self.running:
+            try:
+                sock = socket.create_connection(self.device_address, self.read_timeout)
+            except socket.error as info:
+                log.warning('mochad events %r connect error %r, retry in %r secs', self.device_address, info, backoff)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            log.info('Reading events from mochad %r', self.device_address)
+            backoff = 1.0
+            self.addressed = {}
+            self.function_seen = {}
+            # select() for the timeout rather than socket timeouts, a
+            # socket.timeout leaves a makefile() file object unusable
+            received = b''
+            try:
+                while self.running:
+                    if not select.select([sock], [], [], self.read_timeout)[0]:
+                        continue  # quiet, not an error
+                    data = sock.recv(4096)
+                    if not data:
+                        log.warning('mochad events %r connection closed', self.device_address)
+                        break
+                    lines = (received + data).split(b'\n')
+                    received = lines.pop()  # incomplete line, if any
+                    for line in lines:
+                        self.apply_line(line.decode('latin1'))
+            except socket.error as info:
+                log.warning('mochad events %r error %r', self.device_address, info)
+            finally:
+                sock.close()
+            time.sleep(backoff)
+
+    def apply_line(self, line):
+        commands = self.parse_line(line)
+        if commands and self.pending is not None and ' Tx ' in line:
+            # Our own sends are echoed as Tx, a command still queued for the
+            # same unit/house is newer (state already set), do not revert it
+            commands = [command for command in commands if not self.pending(command[0], command[1])]
+        if commands:
+            self.log.debug('mochad event %r -> %r', line, commands)
+            self.state_table.set_many(commands)
+
+    def close(self):
+        self.running = False
+
+
+x10_state = X10StateTable()
 x10device = None
+x10device_lock = threading.Lock()  # serialize access to the (single) controller
+command_queue = None  # CommandQueue, if None commands are sent synchronously by the request
 
-def simple_app(environ, start_response):
-    global x10device
 
-    status = '200 OK'
-    headers = [('Content-type', 'text/plain')]
-    result= []
+def command_pending(house_code, unit_num):
+    """True if a command for house code/unit (or whole house) is waiting in command_queue"""
+    if command_queue is None:
+        return False
+    return command_queue.is_pending(house_code, unit_num)
 
-    path_info = environ['PATH_INFO']
 
-    # naive URL parsing
-    if not path_info:
-        # not sure how this could happen but....
-        return not_found(environ, start_response)
-    if not path_info.startswith('/x10/'):
-        return not_found(environ, start_response)
-    url_split = path_info.split('/')
-    house_code = url_split[2]  # TODO try/except
+# Command priorities, lower is sent first
+PRIORITY_INTERACTIVE = 0  # e.g. single POST from Home Assistant
+PRIORITY_BULK = 1  # e.g. POST /x10 list of commands, scenes
+PRIORITY_BACKGROUND = 2
+priority_names = {'interactive': PRIORITY_INTERACTIVE, 'bulk': PRIORITY_BULK, 'background': PRIORITY_BACKGROUND}
+priority_labels = dict((priority, name) for name, priority in priority_names.items())
+# seconds a command may wait to be sent, after this it is dropped (and its state change undone)
+default_deadlines = {PRIORITY_INTERACTIVE: 10.0, PRIORITY_BULK: 30.0, PRIORITY_BACKGROUND: 60.0}
+
+command_wait_duration = Histogram('x10_command_queue_wait_seconds', 'Time commands waited in transmit queue', ('priority',))
+commands_expired = Counter('x10_commands_expired_total', 'Commands dropped, waited past deadline', ('priority',))
+metrics.extend([command_wait_duration, commands_expired])
+
+
+class CommandQueue(object):
+    """Background transmit queue in front of an X10 driver.
+
+    Commands are accepted immediately and sent by a single transmit thread.
+    While a command is waiting (at least coalesce_window seconds) a newer
+    command for the same house/unit replaces it, i.e. last state wins, and
+    a whole house command replaces all waiting commands for that house.
+
+    Each command has a priority (PRIORITY_INTERACTIVE, PRIORITY_BULK,
+    PRIORITY_BACKGROUND), the highest priority ready command is sent next
+    so an interactive command does not wait behind a large scene.
+    Within a priority, consecutive sends stay on the same house code whilst
+    it has commands ready. A unit command may overtake waiting commands
+    for other units of its house, but never a waiting whole house command.
+
+    Commands still waiting after their deadline (see default_deadlines)
+    are dropped, not sent late. State has already been updated when a
+    command is accepted, so if state_table is given the change made by a
+    dropped command is undone (see X10StateTable.revert()).
+    """
+
+    def __init__(self, device, device_lock=None, coalesce_window=default_coalesce_window, deadlines=None, log=None,
+                 state_table=None):
+        self.device = device
+        self.device_lock = device_lock or threading.Lock()
+        self.coalesce_window = coalesce_window
+        self.deadlines = dict(default_deadlines)
+        self.deadlines.update(deadlines or {})
+        self.log = log or default_logger
+        self.state_table = state_table
+        self.condition = threading.Condition()
+        # (house_code, unit_num) -> [state, time accepted, priority, deadline, house mask before]
+        self.pending = collections.OrderedDict()
+        self.busy = False
+        self.last_house_code = None
+        self.sent_count = 0
+        self.coalesced_count = 0
+        self.expired_count = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='x10-transmit')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def is_pending(self, house_code, unit_num):
+        """True if a command for house code/unit is waiting, for a whole
+        house (unit_num None) any command for the house"""
+        with self.condition:
+            if unit_num is None:
+                return any(key[0] == house_code for key in self.pending)
+            return (house_code, unit_num) in self.pending or (house_code, None) in self.pending
+
+    def submit(self, house_code, unit_num, state, priority=PRIORITY_INTERACTIVE):
+        """Accept command for transmission, returns immediately"""
+        self.submit_many([(house_code, unit_num, state)], priority)
+
+    def submit_many(self, commands, priority=PRIORITY_INTERACTIVE):
+        """Accept sequence of (house_code, unit_num, state) commands
+        together, returns immediately"""
+        with self.condition:
+            now = time.time()
+            deadline = now + self.deadlines[priority]
+            for house_code, unit_num, state in commands:
+                key = (house_code, unit_num)
+                previous = None
+                if self.state_table is not None:
+                    previous = self.state_table.house_mask(house_code)
+                if unit_num is None:
+                    # whole house command, supersedes everything waiting for this house
+                    # and keeps their best priority and latest deadline
+                    house_priority, house_deadline = priority, deadline
+                    if previous is not None:
+                        previous = self.previous_mask(house_code, previous)
+                    for pending_key in list(self.pending):
+                        if pending_key[0] == house_code:
+                            pending_command = self.pending.pop(pending_key)
+                            house_priority = min(house_priority, pending_command[2])
+                            house_deadline = max(house_deadline, pending_command[3])
+                            self.coalesced_count += 1
+                    self.pending[key] = [state, now, house_priority, house_deadline, previous]
+                else:
+                    pending_command = self.pending.get(key)
+                    if pending_command is None:
+                        self.pending[key] = [state, now, priority, deadline, previous]
+                    else:
+                        # keep place in queue (and accept time) so it is not starved
+                        pending_command[0] = state
+                        pending_command[2] = min(priority, pending_command[2])
+                        pending_command[3] = max(deadline, pending_command[3])
+                        self.coalesced_count += 1
+            self.condition.notify()
+
+    def previous_mask(self, house_code, mask):
+        """Returns house mask as it was before the commands waiting for
+        house_code, mask is the current mask.
+        Caller is expected to hold self.condition"""
+        house_command = self.pending.get((house_code, None))
+        if house_command is not None:
+            # unit commands waiting for the house were accepted after it
+            return house_command[4]
+        for key, command in self.pending.items():
+            if key[0] == house_code:
+                unit_bit = X10StateTable.unit_bit(key[1])
+                mask = (mask & ~unit_bit) | (command[4] & unit_bit)
+        return mask
+
+    def revert(self, key, command):
+        """Undo state change of command that was not sent, units with
+        commands still waiting are left alone.
+        Caller is expected to hold self.condition"""
+        if self.state_table is None or command[4] is None:
+            return
+        house_code, unit_num = key
+        keep_bits = 0
+        for pending_key in self.pending:
+            if pending_key[0] == house_code:
+                keep_bits |= X10StateTable.unit_bit(pending_key[1])
+        self.state_table.revert(house_code, unit_num, command[0], command[4], keep_bits)
+
+    def drop_expired(self, now):
+        """caller is expected to hold self.condition"""
+        for key, command in list(self.pending.items()):
+            state, accept_time, priority, deadline = command[:4]
+            if deadline < now:
+                del self.pending[key]
+                self.revert(key, command)
+                self.expired_count += 1
+                commands_expired.inc((priority_labels[priority],))
+                self.log.warning('x10_command%r dropped, waited %.1f secs', key + (state,), now - accept_time)
+
+    def next_command(self, now):
+        """Returns (key, command, None) for next command ready to send
+        or (None, None, wait_time) if nothing is ready yet.
+        Caller is expected to hold self.condition"""
+        self.drop_expired(now)
+        best = None
+        best_rank = None
+        wait_time = None
+        blocked_houses = set()
+        for order, (key, command) in enumerate(self.pending.items()):
+            house_code = key[0]
+            ready_time = command[1] + self.coalesce_window
+            if ready_time > now:
+                wait_time = ready_time - now
+                break  # everything after this was accepted later
+            if house_code in blocked_houses:
+                continue  # a whole house command for this house goes first
+            if key[1] is None:
+                # unit commands accepted after it must not overtake it
+                # (there are none before it, see submit_many())
+                blocked_houses.add(house_code)
+            rank = (command[2], house_code != self.last_house_code, order)
+            if best_rank is None or rank < best_rank:
+                best, best_rank = (key, command), rank
+        if best is None:
+            return None, None, wait_time
+        return best[0], best[1], None
+
+    def run(self):
+        log = self.log
+        while True:
+            with self.condition:
+                while True:
+                    if not self.running:
+                        return
+                    key, command, wait_time = self.next_command(time.time())
+                    if key is not None:
+                        del self.pending[key]
+                        self.busy = True
+                        break
+                    self.condition.wait(wait_time)
+            house_code, unit_num = key
+            state, accept_time, priority = command[:3]
+            command_wait_duration.observe(time.time() - accept_time, (priority_labels[priority],))
+            try:
+                with self.device_lock:
+                    timed_x10_command(self.device, house_code, unit_num, state)
+                self.sent_count += 1
+            except ControllerUnavailable as info:
+                log.warning('x10_command%r not sent, %s', (house_code, unit_num, state), info)
+                with self.condition:
+                    self.revert(key, command)
+            except Exception:
+                log.exception('x10_command%r failed', (house_code, unit_num, state))
+            with self.condition:
+                self.last_house_code = house_code
+                self.busy = False
+                self.condition.notify_all()
+
+    def join(self, timeout=None):
+        """Wait until all accepted commands have been sent (or timeout)"""
+        end_time = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.pending or self.busy:
+                wait_time = None
+                if end_time is not None:
+                    wait_time = end_time - time.time()
+                    if wait_time <= 0:
+                        return False
+                self.condition.wait(wait_time)
+        return True
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+
+class CommandRejected(x10_any.X10BaseException):
+    """Command not accepted, retry_after is seconds until it is worth
+    trying again, status is the HTTP response status"""
+
+    status = '503 SERVICE UNAVAILABLE'
+
+    def __init__(self, message, retry_after=None):
+        x10_any.X10BaseException.__init__(self, message)
+        self.retry_after = retry_after
+
+
+class ControllerUnavailable(CommandRejected):
+    """Controller is failing (circuit breaker open)"""
+
+
+class HouseCodeNotConfigured(CommandRejected):
+    """No controller handles the house code (see "controllers" config)"""
+
+    status = '404 NOT FOUND'
+
+
+class TooManyRequests(CommandRejected):
+    """Client is sending commands faster than its rate limit, or the
+    transmit queue is full (see AdmissionControl)"""
+
+    status = '429 TOO MANY REQUESTS'
+
+
+default_driver_timeout = 10.0  # seconds, firecracker is about 1 sec, mochad retries need more
+default_breaker_failures = 3
+default_breaker_reset = 30.0  # seconds
+
+breaker_trips = Counter('x10_circuit_breaker_trips_total', 'Times a controller was marked down', ('controller',))
+metrics.append(breaker_trips)
+controller_unavailable = Counter('x10_controller_unavailable_total', 'Commands rejected whilst controller was down', ('house_code',))
+metrics.append(controller_unavailable)
+
+
+class CircuitBreaker(object):
+    """Driver wrapper that stops sending to a failing controller.
+
+    Each x10_command() is bounded by call_timeout seconds (the driver call
+    runs in its own thread, a hung call is left behind). After
+    failure_threshold failures in a row the breaker opens and commands
+    fail immediately with ControllerUnavailable. After reset_timeout
+    seconds one command is let through as a probe (half open), success
+    closes the breaker, failure opens it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, device, failure_threshold=default_breaker_failures, reset_timeout=default_breaker_reset,
+                 call_timeout=default_driver_timeout, log=None):
+        self.device = device
+        self.device_address = getattr(device, 'device_address', None)
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.call_timeout = call_timeout
+        self.log = log or default_logger
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failure_count = 0
+        self.open_until = 0
+        self.call_thread = None  # last driver call, may still be running if it timed out
+
+    def retry_after(self, now=None):
+        """Returns None if a command would be attempted, else seconds until it would be"""
+        if self.state == self.CLOSED:
+            return None
+        if self.state == self.HALF_OPEN:
+            return self.call_timeout  # probe in progress
+        return max(0, self.open_until - (now or time.time())) or None
+
+    def x10_command(self, house_code, unit_num, state):
+        with self.lock:
+            retry_after = self.retry_after()
+            if retry_after is not None:
+                raise ControllerUnavailable('controller %r is down, retry in %d secs' % (self.device_address, retry_after), retry_after)
+            if self.state == self.OPEN:
+                self.log.info('controller %r half open, probing with %r', self.device_address, (house_code, unit_num, state))
+                self.state = self.HALF_OPEN
+        try:
+            self.call(house_code, unit_num, state)
+        except Exception as info:
+            self.record_failure(info)
+            raise
+        self.record_success()
+
+    def call(self, house_code, unit_num, state):
+        """device.x10_command() bounded by call_timeout"""
+        if not self.call_timeout:
+            return self.device.x10_command(house_code, unit_num, state)
+        if self.call_thread is not None and self.call_thread.is_alive():
+            raise ControllerUnavailable('controller %r still busy with timed out command' % (self.device_address,), self.call_timeout)
+        result = []  # exception, if any
+
+        def call_device():
+            try:
+                self.device.x10_command(house_code, unit_num, state)
+                result.append(None)
+            except Exception as info:
+                result.append(info)
+
+        self.call_thread = threading.Thread(target=call_device, name='x10-driver-call')
+        self.call_thread.daemon = True
+        self.call_thread.start()
+        self.call_thread.join(self.call_timeout)
+        if not result:
+            raise ControllerUnavailable('controller %r timed out after %r secs' % (self.device_address, self.call_timeout), self.reset_timeout)
+        if result[0] is not None:
+            raise result[0]
+
+    def record_failure(self, info):
+        with self.lock:
+            self.failure_count += 1
+            if self.state == self.HALF_OPEN or self.failure_count >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.log.warning('controller %r down after %d failures (%r), retry in %r secs',
+                                     self.device_address, self.failure_count, info, self.reset_timeout)
+                    breaker_trips.inc((str(self.device_address),))
+                self.state = self.OPEN
+                self.open_until = time.time() + self.reset_timeout
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                self.log.info('controller %r recovered', self.device_address)
+            self.state = self.CLOSED
+            self.failure_count = 0
+
+
+def add_circuit_breakers(routes, **kwargs):
+    """Returns copy of routes (dict of house code to driver) with each
+    driver wrapped in a CircuitBreaker, kwargs are passed to CircuitBreaker"""
+    breaker_by_device = {}
+    result = {}
+    for house_code, device in routes.items():
+        breaker = breaker_by_device.get(id(device))
+        if breaker is None:
+            breaker = breaker_by_device[id(device)] = CircuitBreaker(device, **kwargs)
+        result[house_code] = breaker
+    return result
+
+
+class RoutingDriver(object):
+    """x10_command() sent to one of several drivers by house code,
+    routes is a dict of house code to driver"""
+
+    def __init__(self, routes):
+        self.routes = routes
+
+    def x10_command(self, house_code, unit_num, state):
+        try:
+            device = self.routes[house_code]
+        except KeyError:
+            raise x10_any.X10InvalidHouseCode('no controller configured for house code %r' % house_code)
+        return device.x10_command(house_code, unit_num, state)
+
+
+class ShardedCommandQueue(object):
+    """CommandQueue per controller, commands routed by house code so
+    commands for houses on different controllers are sent in parallel.
+    Same interface as CommandQueue.
+    routes is a dict of house code to driver."""
+
+    def __init__(self, routes, coalesce_window=default_coalesce_window, deadlines=None, log=None, state_table=None):
+        self.house_queues = {}  # house code -> CommandQueue
+        self.queues = []
+        queue_by_device = {}
+        for house_code in sorted(routes):
+            device = routes[house_code]
+            device_queue = queue_by_device.get(id(device))
+            if device_queue is None:
+                device_queue = queue_by_device[id(device)] = CommandQueue(device, coalesce_window=coalesce_window, deadlines=deadlines, log=log,
+                                                                           state_table=state_table)
+                self.queues.append(device_queue)
+            self.house_queues[house_code] = device_queue
+
+    def __len__(self):
+        return sum(len(device_queue) for device_queue in self.queues)
+
+    @property
+    def coalesced_count(self):
+        return sum(device_queue.coalesced_count for device_queue in self.queues)
+
+    @property
+    def expired_count(self):
+        return sum(device_queue.expired_count for device_queue in self.queues)
+
+    def is_pending(self, house_code, unit_num):
+        device_queue = self.house_queues.get(house_code)
+        return device_queue is not None and device_queue.is_pending(house_code, unit_num)
+
+    def submit(self, house_code, unit_num, state, priority=PRIORITY_INTERACTIVE):
+        self.submit_many([(house_code, unit_num, state)], priority)
+
+    def submit_many(self, commands, priority=PRIORITY_INTERACTIVE):
+        commands_by_queue = collections.OrderedDict()
+        for command in commands:
+            device_queue = self.house_queues.get(command[0])
+            if device_queue is None:
+                raise x10_any.X10InvalidHouseCode('no controller configured for house code %r' % command[0])
+            commands_by_queue.setdefault(device_queue, []).append(command)
+        for device_queue, queue_commands in commands_by_queue.items():
+            device_queue.submit_many(queue_commands, priority)
+
+    def join(self, timeout=None):
+        end_time = None if timeout is None else time.time() + timeout
+        for device_queue in self.queues:
+            if not device_queue.join(None if end_time is None else max(0, end_time - time.time())):
+                return False
+        return True
+
+    def close(self):
+        for device_queue in self.queues:
+            device_queue.close()
+
+
+def read_request_body(environ):
+    # the environment variable CONTENT_LENGTH may be empty or missing
     try:
-        unit_num = url_split[3]
-    except IndexError:
-        unit_num = None
-    print('house_code: %r' % house_code)
-    print('unit_num: %r' % unit_num)
-    # TODO checks after this should probably not be 404 errors..
-    house_code = house_code.upper()
-    if unit_num is not None:
-        unit_num = int(unit_num)
+        request_body_size = int(environ.get('CONTENT_LENGTH', 0))
+    except (ValueError):
+        request_body_size = 0
+    # Read POST body
+    request_body = environ['wsgi.input'].read(request_body_size)
+    return to_string(request_body)
 
-    if environ['REQUEST_METHOD'] == 'GET':
-        house_status = x10_status.get(house_code)
-        if house_status is None:
-            result.append(to_bytes(OFF))
+
+def wants_json(environ):
+    """Client asked for JSON, via Accept header or ?format=json"""
+    return 'format=json' in environ.get('QUERY_STRING', '') or 'application/json' in environ.get('HTTP_ACCEPT', '')
+
+
+def json_response(start_response, data, headers=None):
+    start_response('200 OK', [('Content-type', 'application/json')] + (headers or []))
+    return [to_bytes(json.dumps(data, sort_keys=True))]
+
+
+# ETags are state versions, prefixed with process start time as versions restart from 0
+etag_prefix = '"%x-' % int(time.time())
+no_cache_header = ('Cache-Control', 'no-cache')
+
+
+def make_etag(version, suffix=''):
+    """suffix distinguishes representations of the same state, e.g. -json"""
+    return '%s%d%s"' % (etag_prefix, version, suffix)
+
+
+def etag_matches(environ, etag):
+    """If-None-Match request header includes etag"""
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if not if_none_match:
+        return False
+    if if_none_match == etag or if_none_match.strip() == '*':
+        return True
+    return etag in [entity_tag.strip() for entity_tag in if_none_match.split(',')]
+
+
+def not_modified(start_response, etag, headers=None):
+    start_response('304 NOT MODIFIED', [('ETag', etag), no_cache_header] + (headers or []))
+    return []
+
+
+vary_accept_header = ('Vary', 'Accept')  # /x10/{house code} is text or JSON
+
+
+def normalize_command(house_code, unit_num, state):
+    """Returns (house_code, unit_num, state) ready for x10_command()"""
+    # FIXME normalize state
+    if unit_num is None:
+        # assume whole house
+        # could update HA configuration.yaml with custom body_on/body_off
+        # I _think_ this is easier and understandable for X10 users
+        # albeit all lamps on/all off (i.e. not just lamps) is unintuitive for non-X10 users
+        if state.upper() == ON:
+            state = LAMPS_ON
         else:
-            device_status = house_status.get(unit_num)
-            if device_status is None:
-                result.append(to_bytes(OFF))
-            else:
-                result.append(to_bytes(device_status))
+            # just assume all off
+            state = ALL_OFF
+    return house_code, unit_num, state
+
+
+def request_priority(environ, default=PRIORITY_INTERACTIVE):
+    """Command priority from ?priority=interactive|bulk|background"""
+    query_string = environ.get('QUERY_STRING')
+    if not query_string or 'priority=' not in query_string:
+        return default
+    priority_name = parse_qs(query_string).get('priority', [''])[0].lower()
+    return priority_names.get(priority_name, default)
+
+
+default_client_rate = 0  # commands per second per client address, off as Home Assistant is usually the only client
+default_client_burst = 20
+# commands waiting in transmit queue, the link sends roughly one per second
+# so keep this below the bulk deadline (see default_deadlines)
+default_max_outstanding = 25
+
+requests_throttled = Counter('x10_requests_throttled_total', 'Command requests rejected with 429', ('reason',))
+metrics.append(requests_throttled)
+
+
+class AdmissionControl(object):
+    """Limits how fast commands are accepted, the link sends roughly one
+    command per second so one busy client could otherwise fill the queue.
+
+      * per client (address) token bucket, client_rate commands per second
+        with bursts of up to client_burst commands
+      * at most max_outstanding commands waiting in the transmit queue
+        (outstanding is a callable returning the current count)
+
+    A rate or max of 0 (or None) disables that limit.
+    """
+
+    max_clients = 1024  # forget idle clients (full buckets) beyond this
+    command_time = 1.0  # approximate seconds to send one command, for Retry-After
+
+    def __init__(self, client_rate=None, client_burst=None, max_outstanding=None, outstanding=None, log=None):
+        self.client_rate = client_rate
+        self.client_burst = client_burst or 1
+        self.max_outstanding = max_outstanding
+        self.outstanding = outstanding
+        self.log = log or default_logger
+        self.lock = threading.Lock()
+        self.buckets = {}  # client -> [tokens, last update time, throttled]
+
+    def admit(self, client, count=1):
+        """Raise TooManyRequests if count commands from client should not be accepted"""
+        if self.max_outstanding and self.outstanding is not None:
+            outstanding = self.outstanding()
+            if outstanding + count > self.max_outstanding:
+                requests_throttled.inc(('busy',))
+                self.log.debug('transmit queue full, %d waiting, rejected %d from %r', outstanding, count, client)
+                raise TooManyRequests('transmit queue full, %d commands waiting' % outstanding,
+                                      (outstanding + count - self.max_outstanding) * self.command_time)
+        if not self.client_rate or client is None:
+            return
+        count = min(count, self.client_burst)  # large bulk requests need a full bucket
+        now = time.time()
+        with self.lock:
+            bucket = self.buckets.get(client)
+            if bucket is None:
+                if len(self.buckets) >= self.max_clients:
+                    self.forget_idle(now)
+                bucket = self.buckets[client] = [self.client_burst, now, False]
+            tokens = min(self.client_burst, bucket[0] + (now - bucket[1]) * self.client_rate)
+            bucket[1] = now
+            if tokens < count:
+                bucket[0] = tokens
+                if not bucket[2]:
+                    bucket[2] = True
+                    self.log.warning('client %r over rate limit (%r commands/sec, burst %d), rejecting commands',
+                                     client, self.client_rate, self.client_burst)
+                requests_throttled.inc(('client',))
+                raise TooManyRequests('rate limit exceeded', (count - tokens) / self.client_rate)
+            bucket[0] = tokens - count
+            if bucket[2]:
+                bucket[2] = False
+                self.log.info('client %r back under rate limit', client)
+
+    def forget_idle(self, now):
+        """Drop buckets that have refilled, caller holds self.lock"""
+        for client, bucket in list(self.buckets.items()):
+            if bucket[0] + (now - bucket[1]) * self.client_rate >= self.client_burst:
+                del self.buckets[client]
+
+
+admission = None  # AdmissionControl, if None all commands are accepted
+
+
+def controller_for(house_code):
+    """Returns driver used for house code (may be None)"""
+    if isinstance(x10device, RoutingDriver):
+        return x10device.routes.get(house_code)
+    return x10device
+
+
+def check_controllers(commands):
+    """Raise HouseCodeNotConfigured if any command is for a house code
+    no controller handles, or ControllerUnavailable if for a controller
+    whose circuit breaker is open, so the request fails fast"""
+    now = time.time()
+    for house_code, unit_num, state in commands:
+        device = controller_for(house_code)
+        if device is None and isinstance(x10device, RoutingDriver):
+            raise HouseCodeNotConfigured('no controller configured for house code %s' % house_code)
+        if isinstance(device, CircuitBreaker):
+            retry_after = device.retry_after(now)
+            if retry_after is not None:
+                controller_unavailable.inc((house_code,))
+                raise ControllerUnavailable('controller for house code %s is down' % house_code, retry_after)
+
+
+class OwnerClient(object):
+    """Forwards send_commands() to the driver owner process over its
+    Unix socket (see OwnerServer). One connection per process, opened on
+    first use (so after any fork) and reopened on error.
+    Protocol is a line of JSON each way:
+
+        {"commands": [["A", 1, "ON"]], "priority": 0, "client": "10.0.0.2"}
+        {"accepted": 1}  or  {"error": "TooManyRequests", "message": "...", "retry_after": 3}
+    """
+
+    errors = {
+        'ControllerUnavailable': ControllerUnavailable,
+        'HouseCodeNotConfigured': HouseCodeNotConfigured,
+        'TooManyRequests': TooManyRequests,
+    }
+
+    def __init__(self, socket_path, timeout=5.0, log=None):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.log = log or default_logger
+        self.lock = threading.Lock()
+        self.sock = None
+        self.reply_file = None
+        self.pid = None
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+        self.reply_file = sock.makefile('rb')
+        self.pid = os.getpid()
+
+    def disconnect(self):
+        if self.sock is not None:
+            self.reply_file.close()
+            self.sock.close()
+        self.sock = self.reply_file = None
+
+    def send_commands(self, commands, priority=PRIORITY_INTERACTIVE, client=None):
+        request = to_bytes(json.dumps({'commands': commands, 'priority': priority, 'client': client}) + '\n')
+        with self.lock:
+            # commands set state so are safe to resend if the reply was lost
+            for attempt in (1, 2):
+                try:
+                    if self.sock is None or self.pid != os.getpid():
+                        self.connect()
+                    self.sock.sendall(request)
+                    line = self.reply_file.readline()
+                    if not line:
+                        raise socket.error('driver owner closed connection')
+                    break
+                except socket.error as info:
+                    self.log.warning('driver owner %r error %r', self.socket_path, info)
+                    self.disconnect()
+                    if attempt == 2:
+                        raise ControllerUnavailable('driver owner process unavailable', 1)
+        reply = json.loads(to_string(line))
+        if 'error' in reply:
+            exception_class = self.errors.get(reply['error'], x10_any.X10BaseException)
+            if issubclass(exception_class, CommandRejected):
+                raise exception_class(reply['message'], reply.get('retry_after'))
+            raise exception_class(reply['message'])
+        return reply
+
+
+class OwnerRequestHandler(SocketServer.StreamRequestHandler):
+    """Driver owner side of OwnerClient"""
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(to_string(line))
+                commands = [tuple(command) for command in request['commands']]
+                send_commands(commands, request.get('priority', PRIORITY_INTERACTIVE), request.get('client'))
+                reply = {'accepted': len(commands)}
+            except CommandRejected as info:
+                reply = {'error': info.__class__.__name__, 'message': str(info), 'retry_after': info.retry_after}
+            except Exception as info:
+                default_logger.exception('driver owner request %r failed', line)
+                reply = {'error': 'X10BaseException', 'message': str(info)}
+            self.wfile.write(to_bytes(json.dumps(reply) + '\n'))
+            self.wfile.flush()
+
+
+class OwnerServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Unix socket server in the driver owner process, see use_driver_owner()"""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)  # stale, from a previous run
+        SocketServer.UnixStreamServer.__init__(self, socket_path, OwnerRequestHandler)
+
+
+owner_client = None  # OwnerClient, if set commands are sent by the driver owner process
+
+
+def use_driver_owner(socket_path, shared_state_filename=None):
+    """Make this process an HTTP worker for the driver owner process
+    listening on socket_path (x10_rest.py --owner-socket); state is read
+    from the owner's shared state file, commands are forwarded to it"""
+    global x10_state, owner_client, etag_prefix
+    x10_state = SharedStateTable(shared_state_filename or socket_path + '.state')
+    etag_prefix = x10_state.etag_prefix()
+    owner_client = OwnerClient(socket_path)
+
+
+def make_worker_application(socket_path=None, shared_state_filename=None):
+    """Returns WSGI application for a (multi-process) WSGI server worker
+    of the driver owner, see use_driver_owner(), e.g.
+
+        gunicorn 'x10_rest:make_worker_application()'
+
+    socket_path and shared_state_filename default to environment variables
+    X10_OWNER_SOCKET and X10_SHARED_STATE"""
+    socket_path = socket_path or os.environ.get('X10_OWNER_SOCKET')
+    if not socket_path:
+        raise ValueError('driver owner socket not set, see X10_OWNER_SOCKET')
+    use_driver_owner(socket_path, shared_state_filename or os.environ.get('X10_SHARED_STATE'))
+    return application
+
+
+def send_commands(commands, priority=PRIORITY_INTERACTIVE, client=None):
+    """Send (or queue) normalized commands and update state for GET.
+    Raises HouseCodeNotConfigured if no controller handles a house code,
+    ControllerUnavailable if a controller is down, TooManyRequests
+    if client (address) is over its rate limit or the queue is full."""
+    if owner_client is not None:
+        # driver owner process checks, queues and updates shared state
+        if trace_enabled:
+            start_time = timer()
+        owner_client.send_commands(commands, priority, client)
+        if trace_enabled:
+            add_span('enqueue', start_time)
+        return
+    check_controllers(commands)
+    if admission is not None:
+        admission.admit(client, len(commands))
+    if trace_enabled:
+        start_time = timer()
+    # now send x10 command, one at a time (controller is not shared safely)
+    if command_queue is not None:
+        command_queue.submit_many(commands, priority)
+        if trace_enabled:
+            add_span('enqueue', start_time)
+    else:
+        with x10device_lock:
+            for house_code, unit_num, state in commands:
+                timed_x10_command(x10device, house_code, unit_num, state)
+        if trace_enabled:
+            add_span('transmit', start_time)
+
+    # Now update state for GET
+    # NOTE whilst status is internally correct, delay for HA client to read new status
+    if trace_enabled:
+        start_time = timer()
+    x10_state.set_many(commands)
+    if trace_enabled:
+        add_span('state', start_time)
+
+
+def parse_bulk_commands(request_body):
+    """Parse POST /x10 body, JSON list of {"house": .., "unit": .., "state": ..}
+    unit is optional, missing/null means whole house.
+    Returns list of normalized commands, raises ValueError on bad input."""
+    try:
+        request = json.loads(request_body)
+    except ValueError:
+        raise ValueError('body is not valid JSON')
+    if not isinstance(request, list):
+        raise ValueError('expected JSON list of commands')
+    commands = []
+    for entry in request:
+        if not isinstance(entry, dict):
+            raise ValueError('command %r is not an object' % (entry,))
+        try:
+            house_code = x10_any.normalize_housecode(entry.get('house'))
+            unit_num = entry.get('unit')
+            if unit_num is not None:
+                unit_num = x10_any.normalize_unitnumber(unit_num)
+        except x10_any.X10BaseException as info:
+            raise ValueError(str(info))
+        state = entry.get('state')
+        if not isinstance(state, basestring):
+            raise ValueError('command %r missing state' % (entry,))
+        state = state.upper()
+        if state not in (ON, OFF):
+            raise ValueError('command %r state must be ON or OFF' % (entry,))
+        commands.append(normalize_command(house_code, unit_num, state))
+    return commands
+
+
+def build_routes():
+    """Returns dict of every valid /x10/... PATH_INFO to (house_code, unit_num)
+    (unit_num None for whole house). Under 300 entries per case variant,
+    cheaper than parsing and validating each request."""
+    routes = {}
+    for house_code in house_codes:
+        for path_house_code in (house_code, house_code.lower()):
+            routes['/x10/%s' % path_house_code] = (house_code, None)
+            routes['/x10/%s/' % path_house_code] = (house_code, None)
+            for unit_num in range(1, 16+1):
+                routes['/x10/%s/%d' % (path_house_code, unit_num)] = (house_code, unit_num)
+    return routes
+
+bulk_route = ('*', None)  # /x10 bulk interface, entire state table
+x10_routes = build_routes()
+x10_routes['/x10'] = x10_routes['/x10/'] = bulk_route
+events_route = ('events', None)  # /x10/events, see events_app()
+x10_routes['/x10/events'] = events_route
+
+# Pre-encoded response bodies and headers
+state_bodies = {ON: to_bytes(ON), OFF: to_bytes(OFF)}
+empty_body = b''  # [empty_body] rather than [] so wsgiref sets Content-Length: 0
+text_content_type = ('Content-type', 'text/plain')
+
+
+def bulk_app(environ, start_response):
+    """/x10 - entire state table"""
+    if environ['REQUEST_METHOD'] == 'GET':
+        version, masks = x10_state.versioned_snapshot()
+        etag = make_etag(version)
+        if etag_matches(environ, etag):
+            return not_modified(start_response, etag)
+        return json_response(start_response, x10_state.as_dict(masks), [('ETag', etag), no_cache_header])
     elif environ['REQUEST_METHOD'] == 'POST':
-        # the environment variable CONTENT_LENGTH may be empty or missing
         try:
-            request_body_size = int(environ.get('CONTENT_LENGTH', 0))
-        except (ValueError):
-            request_body_size = 0
-        # Read POST body
-        request_body = environ['wsgi.input'].read(request_body_size)
-        request_body = to_string(request_body)
-        state = request_body
-        # FIXME normalize state
-        if unit_num is None:
-            # assume whole house
-            # could update HA configuration.yaml with custom body_on/body_off
-            # I _think_ this is easier and understandable for X10 users
-            # albeit all lamps on/all off (i.e. not just lamps) is unintuitive for non-X10 users
-            if state.upper() == ON:
-                state = LAMPS_ON
-            else:
-                # just assume all off
-                state = ALL_OFF
-        # now send x10 command
-        x10device.x10_command(house_code, unit_num, state)
+            commands = parse_bulk_commands(read_request_body(environ))
+        except ValueError as info:
+            return bad_request(environ, start_response, str(info))
+        try:
+            send_commands(commands, request_priority(environ, PRIORITY_BULK), environ.get('REMOTE_ADDR'))
+        except CommandRejected as info:
+            return command_rejected(environ, start_response, info)
+        return json_response(start_response, {'accepted': len(commands)})
+    return method_not_allowed(environ, start_response)
+
+
+def metrics_app(environ, start_response):
+    """/metrics - Prometheus text format"""
+    result = '\n'.join(metric.render() for metric in metrics) + '\n'
+    start_response('200 OK', [('Content-type', 'text/plain; version=0.0.4')])
+    return [to_bytes(result)]
+
+
+event_keepalive_interval = 15  # seconds, also how quickly a closed client is noticed
 
-        # Now update state for GET
-        if state == LAMPS_ON:
-            state = ON
-            house_status = {}
-            for temp_unit_num in range(1, 16+1):
-                house_status[temp_unit_num] = state
-            x10_status[house_code] = house_status
-            # NOTE whilst status is internally correct, delay for HA client to read new status
-        elif state == ALL_OFF:
-            state = OFF
-            if x10_status.get(house_code):
-                del x10_status[house_code]
-                # NOTE whilst status is internally correct, delay for HA client to read new status
-        house_status = x10_status.get(house_code)
-        if house_status is None:
-            house_status = {}
-            x10_status[house_code] = house_status
-        house_status[unit_num] = state
-    else:
-        return not_found(environ, start_response)  # FIXME not 404
 
-    start_response(status, headers)
+def events_app(environ, start_response):
+    """/x10/events - Server-Sent Events stream of state changes.
+
+    Starts with an event for every house code, then an event for each
+    house code that changes. Event data is the same JSON as
+    GET /x10/{house code}?format=json, event id is the state version.
+    """
+    release_worker = environ.get('x10.release_worker')
+    if release_worker is None:
+        # single threaded server, stream would block every other request
+        start_response('503 SERVICE UNAVAILABLE', [('Content-Type', 'text/plain')])
+        return [to_bytes('event stream needs worker threads, see --workers')]
+    release_worker()  # do not tie up the pool for the life of the stream
+    start_response('200 OK', [('Content-Type', 'text/event-stream'), no_cache_header])
+    return event_stream(x10_state)
+
+
+def event_stream(state_table):
+    version, masks = state_table.versioned_snapshot()
+    last_masks = [None] * len(masks)
+    yield to_bytes('retry: 5000\n\n')
+    while True:
+        events = []
+        for house_index, mask in enumerate(masks):
+            if mask != last_masks[house_index]:
+                house_code = house_codes[house_index]
+                data = json.dumps({house_code: X10StateTable.mask_as_dict(mask)}, sort_keys=True)
+                events.append('id: %d\nevent: state\ndata: %s\n\n' % (version, data))
+        if events:
+            yield to_bytes(''.join(events))
+        last_masks = masks
+        new_version = state_table.wait_for_change(version, event_keepalive_interval)
+        if new_version == version:
+            yield to_bytes(': keepalive\n\n')
+        else:
+            version, masks = state_table.versioned_snapshot()
+
+
+other_apps = {
+    '/metrics': metrics_app,
+}
+
+
+def parse_scene_targets(targets):
+    """Returns dict of house code to {unit_num: ON/OFF}, unit None for
+    whole house, from scene config e.g. {"A1": "ON", "A2": "OFF", "B": "OFF"}"""
+    result = {}
+    for address, state in targets.items():
+        house_code = x10_any.normalize_housecode(address[:1])
+        unit_num = None
+        if address[1:]:
+            unit_num = x10_any.normalize_unitnumber(address[1:])
+        state = state.upper()
+        if state not in (ON, OFF):
+            raise ValueError('scene state for %r must be ON or OFF, not %r' % (address, state))
+        result.setdefault(house_code, {})[unit_num] = state
     return result
 
 
+def compile_scene(targets):
+    """Returns shortest list of normalized commands (see normalize_command())
+    that sets scene targets (see parse_scene_targets()).
+
+    Commands are grouped by house code. A whole house command (lamps on or
+    all units off) in the majority state is used when the scene sets every
+    unit in the house, at most 1 + 8 commands instead of 16, e.g. 14 units
+    off and 2 on is all units off then the 2 on commands.
+    NOTE lamps on only turns on lamp modules, so scenes using it assume
+    units switched on as a group are lamps (as /x10/{house code} does).
+    """
+    commands = []
+    for house_code in sorted(targets):
+        house_targets = targets[house_code]
+        whole_house_state = house_targets.get(None)
+        unit_targets = sorted((unit_num, state) for unit_num, state in house_targets.items() if unit_num is not None)
+        if whole_house_state is None and len(unit_targets) == 16:
+            # every unit set, start with a whole house command for the majority state
+            on_count = len([1 for unit_num, state in unit_targets if state == ON])
+            whole_house_state = ON if on_count > 16 - on_count else OFF
+        if whole_house_state is not None:
+            commands.append(normalize_command(house_code, None, whole_house_state))
+            unit_targets = [(unit_num, state) for unit_num, state in unit_targets if state != whole_house_state]
+        for unit_num, state in unit_targets:
+            commands.append((house_code, unit_num, state))
+    return commands
+
+
+scenes = {}  # name -> (targets, compiled commands), see load_scenes()
+
+
+def scene_app(environ, start_response):
+    """/scene/{name}
+    POST activates scene (unless body is OFF, which is ignored),
+    GET is ON if the current state matches the scene else OFF,
+    i.e. can be used as a Home Assistant REST switch"""
+    name = environ['PATH_INFO'][len('/scene/'):]
+    targets, commands = scenes[name]
+    method = environ['REQUEST_METHOD']
+    if method == 'GET':
+        matches = True
+        for house_code, house_targets in targets.items():
+            for unit_num, state in house_targets.items():
+                if x10_state.get(house_code, unit_num) != state:
+                    matches = False
+        start_response('200 OK', [text_content_type, no_cache_header])
+        return [state_bodies[ON if matches else OFF]]
+    elif method == 'POST':
+        if read_request_body(environ).strip().upper() != OFF:
+            try:
+                send_commands(commands, request_priority(environ, PRIORITY_BULK), environ.get('REMOTE_ADDR'))
+            except CommandRejected as info:
+                return command_rejected(environ, start_response, info)
+        start_response('200 OK', [text_content_type])
+        return [empty_body]
+    return method_not_allowed(environ, start_response)
+
+
+def scene_list_app(environ, start_response):
+    """/scene - JSON of scene names to compiled commands"""
+    result = {}
+    for name, (targets, commands) in scenes.items():
+        result[name] = [{'house': house_code, 'unit': unit_num, 'state': state} for house_code, unit_num, state in commands]
+    return json_response(start_response, result)
+
+
+def mount_remote(log=None):
+    """Serve x10_demoweb.py big remote page on /remote, sharing this
+    server's driver, transmit queue and state table (one process, one
+    serial port/mochad connection), the remote shows which units are on"""
+    log = log or default_logger
+    import x10_demoweb  # only needed for the remote
+
+    def remote_send_command(house_code, unit_num, state, client=None):
+        send_commands([normalize_command(house_code, unit_num, state)], client=client)
+
+    x10_demoweb.send_command = remote_send_command
+    x10_demoweb.state_table = x10_state
+    x10_demoweb.prerender_pages()
+    other_apps['/remote'] = x10_demoweb.simple_app
+    other_apps['/remote/'] = x10_demoweb.simple_app
+    log.info('Serving web remote on /remote')
+
+
+def load_scenes(scenes_config, log=None):
+    """Compile "scenes" from config and make them available as /scene/{name}"""
+    log = log or default_logger
+    other_apps['/scene'] = scene_list_app
+    for name, scene_targets in scenes_config.items():
+        targets = parse_scene_targets(scene_targets)
+        commands = compile_scene(targets)
+        scenes[name] = (targets, commands)
+        other_apps['/scene/%s' % name] = scene_app
+        log.info('scene %r: %d targets -> %d commands', name, len(scene_targets), len(commands))
+
+
+def house_get(environ, start_response, house_code):
+    """GET /x10/{house code}, whole house ON/OFF text or house state JSON
+    (see wants_json()), each with its own ETag"""
+    if wants_json(environ):
+        etag = make_etag(x10_state.house_version(house_code), '-json')
+        if etag_matches(environ, etag):
+            return not_modified(start_response, etag, [vary_accept_header])
+        return json_response(start_response, {house_code: x10_state.house_as_dict(house_code)}, [('ETag', etag), no_cache_header, vary_accept_header])
+    etag = make_etag(x10_state.house_version(house_code))
+    if etag_matches(environ, etag):
+        return not_modified(start_response, etag, [vary_accept_header])
+    start_response('200 OK', [text_content_type, ('ETag', etag), no_cache_header, vary_accept_header])
+    return [state_bodies[x10_state.get(house_code, None)]]
+
+
+def simple_app(environ, start_response):
+    route = x10_routes.get(environ.get('PATH_INFO'))
+    if route is None:
+        path_info = environ.get('PATH_INFO') or ''
+        if path_info.startswith('/x10/'):
+            return bad_request(environ, start_response, 'invalid X10 house code/unit number %r' % path_info)
+        app = other_apps.get(path_info)
+        if app is not None:
+            return app(environ, start_response)
+        return not_found(environ, start_response)
+    if route is bulk_route:
+        return bulk_app(environ, start_response)
+    if route is events_route:
+        return events_app(environ, start_response)
+    house_code, unit_num = route
+    method = environ['REQUEST_METHOD']
+    default_logger.debug('%s house_code %r unit_num %r', method, house_code, unit_num)
+
+    if method == 'GET':
+        # version read before state, so an ETag is never newer than the body
+        if unit_num is None:
+            return house_get(environ, start_response, house_code)
+        etag = make_etag(x10_state.house_version(house_code))
+        if etag_matches(environ, etag):
+            return not_modified(start_response, etag)
+        start_response('200 OK', [text_content_type, ('ETag', etag), no_cache_header])
+        if trace_enabled:
+            start_time = timer()
+            state = x10_state.get(house_code, unit_num)
+            add_span('state', start_time)
+            return [state_bodies[state]]
+        return [state_bodies[x10_state.get(house_code, unit_num)]]
+    elif method == 'POST':
+        state = read_request_body(environ)
+        try:
+            send_commands([normalize_command(house_code, unit_num, state)], request_priority(environ), environ.get('REMOTE_ADDR'))
+        except CommandRejected as info:
+            return command_rejected(environ, start_response, info)
+        start_response('200 OK', [text_content_type])
+        return [empty_body]
+    return method_not_allowed(environ, start_response)
+
+
+metrics_methods = ('GET', 'POST', 'HEAD', 'PUT', 'DELETE')  # others are labelled "other", methods come from clients
+
+
+def metrics_middleware(app):
+    """Wrap WSGI app, recording request latency by method and status"""
+    def metrics_wrapper(environ, start_response):
+        start_time = timer()
+        response_status = ['500']  # if app raises
+        http_requests_in_progress.inc()
+
+        def metrics_start_response(status, headers, exc_info=None):
+            response_status[0] = status[:3]
+            return start_response(status, headers, exc_info)
+
+        try:
+            return app(environ, metrics_start_response)
+        finally:
+            http_requests_in_progress.inc(amount=-1)
+            method = environ.get('REQUEST_METHOD')
+            if method not in metrics_methods:
+                method = 'other'
+            http_request_duration.observe(timer() - start_time, (method, response_status[0]))
+    return metrics_wrapper
+
+
+class TracedResponse(object):
+    """Response iterable that logs the request trace when the server closes it,
+    time between the app returning and close is the response span (writing
+    the body to the client)"""
+
+    def __init__(self, result, trace, start_time, log):
+        self.result = result
+        self.trace = trace
+        self.start_time = start_time
+        self.log = log
+
+    def __iter__(self):
+        return iter(self.result)
+
+    def close(self):
+        try:
+            close = getattr(self.result, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            now = timer()
+            spans = self.trace['spans']
+            spans['response'] = now - self.start_time - self.trace['app']
+            del self.trace['app']
+            self.trace['total'] = now - self.start_time
+            for name in spans:
+                spans[name] = round(spans[name] * 1000, 3)  # milliseconds
+            self.trace['total'] = round(self.trace['total'] * 1000, 3)
+            self.log.info('trace %s', json.dumps(self.trace, sort_keys=True))
+
+
+def trace_middleware(app, log=None):
+    """Wrap WSGI app, logging a JSON line of timing spans (milliseconds) per request:
+
+      * parse - routing, reading and parsing the request
+      * state - state table read/update
+      * enqueue or transmit - transmit queue submit (or controller send with --sync)
+      * response - writing the response
+    """
+    log = log or default_logger
+
+    def trace_wrapper(environ, start_response):
+        start_time = timer()
+        trace = {'method': environ.get('REQUEST_METHOD'), 'path': environ.get('PATH_INFO'),
+                 'client': environ.get('REMOTE_ADDR'), 'status': '500'}
+        trace_local.spans = spans = {}
+
+        def trace_start_response(status, headers, exc_info=None):
+            trace['status'] = status[:3]
+            return start_response(status, headers, exc_info)
+
+        try:
+            result = app(environ, trace_start_response)
+        finally:
+            trace_local.spans = None
+        trace['app'] = timer() - start_time
+        spans['parse'] = trace['app'] - sum(spans.values())
+        trace['spans'] = spans
+        return TracedResponse(result, trace, start_time, log)
+    return trace_wrapper
+
+
+class RequestProfiler(object):
+    """On demand cProfile of request handling in every worker thread.
+    Whilst active each request is run under its own cProfile.Profile,
+    results are combined by stop(). Inactive cost is one attribute check.
+
+    Only one profiler can be active at a time (Python 3.12+ raises
+    ValueError for a second), so a request that overlaps one being
+    profiled is run unprofiled and counted as skipped."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiling = threading.Lock()  # held whilst a request is profiled
+        self.active = False
+        self.profiles = []
+        self.skipped_count = 0
+
+    def start(self):
+        """Returns False if already running"""
+        with self.lock:
+            if self.active:
+                return False
+            self.profiles = []
+            self.skipped_count = 0
+            self.active = True
+            return True
+
+    def stop(self, sort='cumulative', limit=40):
+        """Returns pstats text report"""
+        with self.lock:
+            self.active = False
+            profiles, self.profiles = self.profiles, []
+            skipped_count = self.skipped_count
+        if not profiles:
+            return 'no requests whilst profiling\n'
+        out = StringIO()
+        stats = pstats.Stats(profiles[0], stream=out)
+        for profile in profiles[1:]:
+            stats.add(profile)
+        out.write('%d requests profiled, %d overlapping requests not profiled\n' % (len(profiles), skipped_count))
+        stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def middleware(self, app):
+        def profile_wrapper(environ, start_response):
+            if not self.active:
+                return app(environ, start_response)
+            if not self.profiling.acquire(False):
+                with self.lock:
+                    self.skipped_count += 1
+                return app(environ, start_response)
+            profile = cProfile.Profile()
+            try:
+                # NOTE only the app call, not iterating a streamed response
+                return profile.runcall(app, environ, start_response)
+            finally:
+                self.profiling.release()
+                with self.lock:
+                    if self.active:
+                        self.profiles.append(profile)
+        return profile_wrapper
+
+
+request_profiler = RequestProfiler()
+max_profile_seconds = 300
+admin_addresses = ('127.0.0.1', '::1', '::ffff:127.0.0.1')
+
+
+def profile_app(environ, start_response):
+    """/admin/profile?seconds=N - profile requests for N seconds (default 10)
+    and return cProfile stats as text. Only from localhost."""
+    if environ.get('REMOTE_ADDR') not in admin_addresses:
+        start_response('403 FORBIDDEN', [('Content-Type', 'text/plain')])
+        return [to_bytes('admin only from localhost')]
+    try:
+        seconds = float((parse_qs(environ.get('QUERY_STRING', '')).get('seconds') or [10])[0])
+    except ValueError:
+        return bad_request(environ, start_response, 'seconds must be a number')
+    seconds = min(max(seconds, 0), max_profile_seconds)
+    release_worker = environ.get('x10.release_worker')
+    if release_worker is None:
+        # single threaded server, sleeping would block every other request
+        start_response('503 SERVICE UNAVAILABLE', [('Content-Type', 'text/plain')])
+        return [to_bytes('profiling needs worker threads, see --workers')]
+    if not request_profiler.start():
+        start_response('409 CONFLICT', [('Content-Type', 'text/plain')])
+        return [to_bytes('profile already running')]
+    release_worker()  # do not tie up the pool whilst waiting
+    default_logger.info('profiling requests for %r secs', seconds)
+    try:
+        time.sleep(seconds)
+    finally:
+        report = request_profiler.stop()
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [to_bytes(report)]
+
+
+other_apps['/admin/profile'] = profile_app
+
+application = metrics_middleware(request_profiler.middleware(simple_app))
+
+
 class MyWSGIRequestHandler(WSGIRequestHandler):
     """Do not perform Fully Qualified Domain Lookup.
     One networks with missing (or poor) DNS, getfqdn can take over 5 secs
@@ -196,6 +2180,184 @@ class MyWSGIRequestHandler(WSGIRequestHandler):
         host, port = self.client_address[:2]
         return host  # socket.getfqdn(host)
 
+    def get_environ(self):
+        environ = WSGIRequestHandler.get_environ(self)
+        release_worker = getattr(self.server, 'release_worker', None)
+        if release_worker is not None:
+            environ['x10.release_worker'] = release_worker
+        return environ
+
+    def log_request(self, code='-', size='-'):
+        """Access log, only when debugging (default is a stderr write per request)"""
+        if default_logger.isEnabledFor(logging.DEBUG):
+            WSGIRequestHandler.log_request(self, code, size)
+
+    def log_message(self, format, *args):
+        default_logger.info('%s - %s', self.address_string(), format % args)
+
+
+class RequestBody(object):
+    """wsgi.input limited to the request Content-Length, so an app can not
+    read into the next request on a persistent connection"""
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return b''
+        data = self.rfile.read(size)
+        self.remaining -= len(data)
+        if not data:
+            self.remaining = 0  # client went away
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return b''
+        data = self.rfile.readline(size)
+        self.remaining -= len(data)
+        if not data:
+            self.remaining = 0
+        return data
+
+    def readlines(self, hint=-1):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def discard(self, limit):
+        """Read and throw away unread body, returns False if more than limit
+        bytes were left (connection should be closed instead)"""
+        if self.remaining > limit:
+            return False
+        while self.read(8192):
+            pass
+        return True
+
+
+class KeepAliveServerHandler(ServerHandler):
+    """wsgiref ServerHandler that responds with HTTP/1.1 and decides if the
+    connection can stay open, see KeepAliveWSGIRequestHandler"""
+
+    http_version = '1.1'
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        request_handler = self.request_handler
+        if 'Content-Length' not in self.headers and self.status[:3] not in ('204', '304'):
+            # e.g. event stream, only way for client to find the end is close
+            request_handler.close_connection = True
+        if request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+        elif request_handler.request_version == 'HTTP/1.0':
+            self.headers['Connection'] = 'keep-alive'
+
+    def handle_error(self):
+        if self.headers_sent:
+            # response is now incomplete, client can not recover on this connection
+            self.request_handler.close_connection = True
+        ServerHandler.handle_error(self)
+
+
+class KeepAliveWSGIRequestHandler(MyWSGIRequestHandler):
+    """MyWSGIRequestHandler supporting HTTP/1.1 persistent connections.
+
+    Handles requests whilst the next one has already arrived (e.g. pipelined),
+    then returns with self.keep_alive set and the connection (and its buffered
+    input) open. ThreadPoolWSGIServer then parks the connection until the
+    next request arrives, so idle connections do not hold worker threads.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    max_discard = 64 * 1024  # unread request body bytes to skip rather than close
+
+    def setup(self):
+        self.timeout = self.server.keep_alive_timeout  # applied to socket by StreamRequestHandler
+        MyWSGIRequestHandler.setup(self)
+        self.request_count = 0
+        self.keep_alive = False
+
+    def handle(self):
+        """Handle requests until connection is idle, closed or reached max requests"""
+        self.keep_alive = False
+        while True:
+            self.close_connection = True
+            self.handle_one_request()
+            if self.close_connection:
+                return
+            if not self.input_pending():
+                self.keep_alive = True
+                return
+
+    def resume(self):
+        """Next request has arrived on parked connection"""
+        try:
+            self.handle()
+        finally:
+            self.finish()
+
+    def finish(self):
+        if self.keep_alive:
+            self.wfile.flush()  # leave connection open for next request
+        else:
+            MyWSGIRequestHandler.finish(self)
+
+    def input_pending(self):
+        """(Start of) next request already arrived"""
+        if select.select([self.connection], [], [], 0)[0]:
+            return True
+        peek = getattr(self.rfile, 'peek', None)
+        if peek is None:
+            return False  # Python 2, assume nothing buffered
+        self.connection.settimeout(0.0)
+        try:
+            return bool(peek(1))
+        except (IOError, OSError):
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def handle_one_request(self):
+        """Based on wsgiref.simple_server.WSGIRequestHandler.handle()"""
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.timeout:
+            return
+        if not self.raw_requestline:
+            return  # client closed connection
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        if not self.parse_request():  # An error code has been sent, just exit
+            return
+        self.request_count += 1
+        if self.request_count >= self.server.max_keep_alive_requests:
+            self.close_connection = True
+        try:
+            content_length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            content_length = 0
+            self.close_connection = True
+        if self.headers.get('Transfer-Encoding'):
+            # chunked request body not supported, can not find next request
+            self.close_connection = True
+        body = RequestBody(self.rfile, content_length)
+        handler = KeepAliveServerHandler(body, self.wfile, self.get_stderr(), self.get_environ(), multithread=True)
+        handler.request_handler = self      # backpointer for logging
+        handler.run(self.server.get_app())
+        if not self.close_connection and not body.discard(self.max_discard):
+            self.close_connection = True
+
 
 class MyWSGIServer(WSGIServer):
     """Avoid default Python socket server oddities.
@@ -221,11 +2383,325 @@ class MyWSGIServer(WSGIServer):
     def server_bind(self):
         """Override server_bind to store the server name."""
         SocketServer.TCPServer.server_bind(self)
+        self.set_server_name()
+
+    def set_server_name(self):
         host, port = self.socket.getsockname()[:2]
         self.server_name = host  # socket.getfqdn(host)  i.e. use as-is do *not* perform reverse lookup
         self.server_port = port
         self.setup_environ()
 
+    def use_socket(self, listen_socket):
+        """Serve on an already bound and listening socket, e.g. from
+        systemd socket activation (see inherited_socket()), for servers
+        created with bind_and_activate=False"""
+        self.socket.close()
+        self.socket = listen_socket
+        self.server_address = listen_socket.getsockname()
+        self.set_server_name()
+
+
+class ThreadPoolWSGIServer(MyWSGIServer):
+    """MyWSGIServer that hands each connection to a fixed pool of worker threads.
+
+    A controller send can take around a second (e.g. CM17A), with a
+    single thread every other request (e.g. Home Assistant polling
+    state) waits behind it. With a pool, only access to the controller
+    is serialized (see x10device_lock), GET requests are answered
+    immediately by the other workers.
+    """
+
+    worker_count = default_worker_count
+    request_queue_size = 64  # listen backlog, SocketServer default of 5 drops connections during bursts
+    keep_alive_timeout = default_keep_alive_timeout  # used by KeepAliveWSGIRequestHandler
+    max_keep_alive_requests = default_max_keep_alive_requests
+
+    def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True, worker_count=None,
+                 keep_alive_timeout=None, max_keep_alive_requests=None):
+        MyWSGIServer.__init__(self, server_address, RequestHandlerClass, bind_and_activate)
+        if worker_count is not None:
+            self.worker_count = worker_count
+        if keep_alive_timeout is not None:
+            self.keep_alive_timeout = keep_alive_timeout
+        if max_keep_alive_requests is not None:
+            self.max_keep_alive_requests = max_keep_alive_requests
+        # persistent connections waiting for their next request
+        self.idle_connections = {}  # socket -> (request handler, time to close)
+        self.idle_lock = threading.Lock()
+        self.idle_thread = None
+        try:
+            self.idle_wakeup, self.idle_wakeup_send = socket.socketpair()
+        except (AttributeError, socket.error):
+            # e.g. Python 2 under Windows, poll instead
+            self.idle_wakeup = self.idle_wakeup_send = None
+        self.request_queue = queue.Queue()
+        self.workers = []
+        self.worker_state = threading.local()
+        self.started_count = 0
+        for worker_num in range(self.worker_count):
+            self.start_worker()
+
+    def start_worker(self):
+        worker = threading.Thread(target=self.process_request_worker, name='http-worker-%d' % self.started_count)
+        worker.daemon = True
+        self.started_count += 1
+        self.workers.append(worker)
+        worker.start()
+
+    def release_worker(self):
+        """Called (via environ['x10.release_worker']) by a long running
+        request, e.g. an event stream. Starts a replacement worker, the
+        calling worker thread exits once its request completes."""
+        self.worker_state.released = True
+        self.start_worker()
+
+    def process_request(self, request, client_address):
+        """Queue request for next available worker"""
+        self.request_queue.put((request, client_address))
+
+    def finish_request(self, request, client_address):
+        """Returns request handler"""
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def process_request_worker(self):
+        while True:
+            item = self.request_queue.get()
+            if item is None:
+                break
+            handler = None
+            if isinstance(item, tuple):
+                # new connection
+                request, client_address = item
+                try:
+                    handler = self.finish_request(request, client_address)
+                except Exception:
+                    self.handle_error(request, client_address)
+            else:
+                # parked persistent connection, next request arrived
+                handler = item
+                request, client_address = handler.request, handler.client_address
+                try:
+                    handler.resume()
+                except Exception:
+                    handler = None
+                    self.handle_error(request, client_address)
+            if getattr(handler, 'keep_alive', False):
+                self.park(handler)
+            else:
+                self.shutdown_request(request)
+            if getattr(self.worker_state, 'released', False):
+                self.workers.remove(threading.current_thread())
+                break
+
+    def park(self, handler):
+        """Wait (without a worker) for next request on persistent connection"""
+        with self.idle_lock:
+            self.idle_connections[handler.connection] = (handler, time.time() + self.keep_alive_timeout)
+            if self.idle_thread is None:
+                self.idle_thread = threading.Thread(target=self.idle_worker, name='http-idle')
+                self.idle_thread.daemon = True
+                self.idle_thread.start()
+        if self.idle_wakeup_send is not None:
+            self.idle_wakeup_send.send(b'x')
+
+    def close_idle(self, handler):
+        handler.keep_alive = False
+        try:
+            handler.finish()
+        except Exception:
+            pass
+        self.shutdown_request(handler.request)
+
+    def idle_worker(self):
+        """Hand parked connections back to the pool when readable, close
+        after keep_alive_timeout (or if client closed, i.e. readable
+        and then read nothing)"""
+        while True:
+            with self.idle_lock:
+                connections = list(self.idle_connections)
+                close_times = [close_time for _, close_time in self.idle_connections.values()]
+            now = time.time()
+            wait_time = max(0, min(close_times) - now) if close_times else None
+            wait_on = connections
+            if self.idle_wakeup is not None:
+                wait_on = connections + [self.idle_wakeup]
+            elif wait_time is None or wait_time > 0.01:
+                wait_time = 0.01  # no wakeup socket, poll for new connections
+            try:
+                readable = select.select(wait_on, [], [], wait_time)[0]
+            except (select.error, ValueError, socket.error):
+                # a connection was closed under us, drop closed ones and retry
+                readable = []
+                with self.idle_lock:
+                    for connection in list(self.idle_connections):
+                        if connection.fileno() < 0:
+                            del self.idle_connections[connection]
+            if self.idle_wakeup is not None and self.idle_wakeup in readable:
+                self.idle_wakeup.recv(4096)
+            now = time.time()
+            to_close = []
+            with self.idle_lock:
+                for connection in readable:
+                    parked = self.idle_connections.pop(connection, None)
+                    if parked is not None:
+                        self.request_queue.put(parked[0])
+                for connection, (handler, close_time) in list(self.idle_connections.items()):
+                    if close_time <= now:
+                        del self.idle_connections[connection]
+                        to_close.append(handler)
+            for handler in to_close:
+                self.close_idle(handler)
+
+    def server_close(self):
+        MyWSGIServer.server_close(self)
+        if not hasattr(self, 'workers'):
+            return  # bind failed, called from SocketServer __init__
+        for worker in list(self.workers):
+            self.request_queue.put(None)
+        with self.idle_lock:
+            idle_handlers = [handler for handler, _ in self.idle_connections.values()]
+            self.idle_connections.clear()
+        for handler in idle_handlers:
+            self.close_idle(handler)
+
+
+def inherited_socket():
+    """Returns listening socket passed by systemd socket activation
+    (LISTEN_FDS/LISTEN_PID environment variables, first fd is 3), or None.
+    See sd_listen_fds(3), the unit's .socket file does the bind so the
+    port accepts connections even whilst x10_rest is (re)starting."""
+    listen_fds_start = 3
+    if os.environ.get('LISTEN_PID') != str(os.getpid()):
+        return None
+    if int(os.environ.get('LISTEN_FDS', '0')) < 1:
+        return None
+    for name in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+        os.environ.pop(name, None)  # not for child processes
+    try:
+        listen_socket = socket.socket(fileno=listen_fds_start)
+    except TypeError:
+        # Python 2, no fileno parameter (and fromfd() dups)
+        listen_socket = socket.fromfd(listen_fds_start, socket.AF_INET, socket.SOCK_STREAM)
+        os.close(listen_fds_start)
+    return listen_socket
+
+
+def make_x10_server(host, port, app, worker_count=default_worker_count, keep_alive_timeout=None,
+                    max_keep_alive_requests=default_max_keep_alive_requests, listen_socket=None):
+    """Like wsgiref.simple_server.make_server() but with optional worker pool.
+    worker_count of 0 means single threaded server.
+    keep_alive_timeout of None means close connection after each request
+    (like wsgiref), otherwise HTTP/1.1 persistent connections are kept for
+    keep_alive_timeout idle seconds (requires a worker pool).
+    listen_socket, if given, is used instead of binding host and port.
+    """
+    bind_and_activate = listen_socket is None
+    if worker_count:
+        if keep_alive_timeout:
+            handler_class = KeepAliveWSGIRequestHandler
+        else:
+            handler_class = MyWSGIRequestHandler
+        httpd = ThreadPoolWSGIServer((host, port), handler_class, bind_and_activate, worker_count=worker_count,
+                                     keep_alive_timeout=keep_alive_timeout, max_keep_alive_requests=max_keep_alive_requests)
+    else:
+        if keep_alive_timeout:
+            default_logger.warning('persistent connections need worker threads, ignoring keep alive')
+        httpd = MyWSGIServer((host, port), MyWSGIRequestHandler, bind_and_activate)
+    if listen_socket is not None:
+        httpd.use_socket(listen_socket)
+    httpd.set_app(app)
+    return httpd
+
+
+def pop_option(argv, option_name, default=None):
+    """Remove `option_name VALUE` from argv (in place) and return VALUE.
+    If option_name is not present, return default.
+    """
+    try:
+        option_index = argv.index(option_name)
+    except ValueError:
+        return default
+    try:
+        value = argv[option_index + 1]
+    except IndexError:
+        raise SystemExit('missing value for %s' % option_name)
+    del argv[option_index:option_index + 2]
+    return value
+
+
+def parse_house_codes(house_code_ranges):
+    """Returns string of house codes from e.g. "A-D,F" (-> "ABCDF")"""
+    result = []
+    for house_code_range in house_code_ranges.upper().replace(' ', '').split(','):
+        if not house_code_range:
+            continue
+        if '-' in house_code_range:
+            first, last = house_code_range.split('-')
+        else:
+            first = last = house_code_range
+        first, last = x10_any.normalize_housecode(first), x10_any.normalize_housecode(last)
+        for house_code in house_codes[house_codes.index(first):house_codes.index(last) + 1]:
+            if house_code not in result:
+                result.append(house_code)
+    return ''.join(result)
+
+
+def load_config(filename):
+    """Returns dict from JSON config file, see README"""
+    config_file = open(filename, 'r')
+    try:
+        return json.load(config_file)
+    finally:
+        config_file.close()
+
+
+def make_driver(controller_config, log=None):
+    """Returns driver for a "controllers" entry in config, one of:
+
+        {"type": "firecracker", "port": "/dev/ttyUSB0"}
+        {"type": "mochad", "host": "localhost", "port": 1099, "mochad_type": "rf"}
+        {"type": "simulate", "profile": "pl"}
+    """
+    log = log or default_logger
+    controller_type = controller_config.get('type', 'firecracker')
+    if controller_type == 'firecracker':
+        return LazyDriver(lambda: x10_any.FirecrackerDriver(controller_config.get('port')), controller_config.get('port'), log=log)
+    elif controller_type == 'mochad':
+        return PersistentMochadDriver((controller_config.get('host', mochad_host), int(controller_config.get('port', mochad_port))),
+                                      controller_config.get('mochad_type', mochad_type),
+                                      timeout=float(controller_config.get('timeout', mochad_timeout)), log=log)
+    elif controller_type == 'simulate':
+        import x10_sim  # only needed for simulation
+        return x10_sim.parse_simulate_option(controller_config.get('profile', 'pl'))
+    raise ValueError('unknown controller type %r' % controller_type)
+
+
+def make_routes(controllers_config, log=None):
+    """Returns dict of house code to driver from "controllers" config list,
+    a controller without "houses" handles all house codes not listed by
+    another controller"""
+    log = log or default_logger
+    routes = {}
+    default_device = None
+    for controller_config in controllers_config:
+        device = make_driver(controller_config, log)
+        if 'houses' in controller_config:
+            controller_house_codes = parse_house_codes(controller_config['houses'])
+            for house_code in controller_house_codes:
+                if house_code in routes:
+                    raise ValueError('house code %r has more than one controller' % house_code)
+                routes[house_code] = device
+        else:
+            if default_device is not None:
+                raise ValueError('only one controller can omit "houses"')
+            default_device = device
+            controller_house_codes = '(remaining)'
+        log.info('%s controller %r for house codes %s', controller_config.get('type', 'firecracker'), device.device_address, controller_house_codes)
+    if default_device is not None:
+        for house_code in house_codes:
+            routes.setdefault(house_code, default_device)
+    return routes
+
 
 def main(argv=None):
     if argv is None:
@@ -233,18 +2709,88 @@ def main(argv=None):
 
     global serial_port_name
     global x10device
+    global command_queue
+    global admission
+    global trace_enabled
+    global x10_state
+    global etag_prefix
+    global mochad_host, mochad_port, mochad_type, mochad_timeout
 
     log = default_logger
     log.setLevel(logging.INFO)
-    log.setLevel(logging.DEBUG)  # DEBUG
+    if '-v' in argv:
+        argv.remove('-v')
+        log.setLevel(logging.DEBUG)  # DEBUG, includes a log line per request
 
     log.info('x10 rest version %s', version)
     # The dumbest arg processing...
-    if '-m' in argv:
+    worker_count = int(pop_option(argv, '--workers', os.environ.get('X10_WORKERS', default_worker_count)))
+    coalesce_window = float(pop_option(argv, '--coalesce-window', os.environ.get('X10_COALESCE_WINDOW', default_coalesce_window)))
+    mochad_host = pop_option(argv, '--mochad-host', os.environ.get('X10_MOCHAD_HOST', mochad_host))
+    mochad_port = int(pop_option(argv, '--mochad-port', os.environ.get('X10_MOCHAD_PORT', mochad_port)))
+    mochad_type = pop_option(argv, '--mochad-type', os.environ.get('X10_MOCHAD_TYPE', mochad_type))
+    mochad_timeout = float(pop_option(argv, '--mochad-timeout', os.environ.get('X10_MOCHAD_TIMEOUT', mochad_timeout)))
+    state_filename = pop_option(argv, '--state-file', os.environ.get('X10_STATE_FILE'))
+    simulate = pop_option(argv, '--simulate', os.environ.get('X10_SIMULATE'))
+    config_filename = pop_option(argv, '--config', os.environ.get('X10_CONFIG'))
+    config = {}
+    if config_filename:
+        config = load_config(config_filename)
+        log.info('Using config %r', config_filename)
+    keep_alive_timeout = pop_option(argv, '--keep-alive', os.environ.get('X10_KEEP_ALIVE'))
+    if keep_alive_timeout is not None:
+        keep_alive_timeout = float(keep_alive_timeout)
+    max_keep_alive_requests = int(pop_option(argv, '--max-requests', os.environ.get('X10_MAX_REQUESTS', default_max_keep_alive_requests)))
+    driver_timeout = float(pop_option(argv, '--driver-timeout', os.environ.get('X10_DRIVER_TIMEOUT', default_driver_timeout)))
+    breaker_failures = int(pop_option(argv, '--breaker-failures', os.environ.get('X10_BREAKER_FAILURES', default_breaker_failures)))
+    breaker_reset = float(pop_option(argv, '--breaker-reset', os.environ.get('X10_BREAKER_RESET', default_breaker_reset)))
+    client_rate = float(pop_option(argv, '--client-rate', os.environ.get('X10_CLIENT_RATE', default_client_rate)))
+    client_burst = int(pop_option(argv, '--client-burst', os.environ.get('X10_CLIENT_BURST', default_client_burst)))
+    max_outstanding = int(pop_option(argv, '--max-outstanding', os.environ.get('X10_MAX_OUTSTANDING', default_max_outstanding)))
+    owner_socket = pop_option(argv, '--owner-socket', os.environ.get('X10_OWNER_SOCKET'))
+    shared_state_filename = pop_option(argv, '--shared-state', os.environ.get('X10_SHARED_STATE'))
+    serve_http = True
+    if '--no-http' in argv:
+        argv.remove('--no-http')
+        serve_http = False
+    if owner_socket:
+        shared_state_filename = shared_state_filename or owner_socket + '.state'
+        x10_state = SharedStateTable(shared_state_filename, writable=True)
+        etag_prefix = x10_state.etag_prefix()
+        log.info('Using shared state file %r', shared_state_filename)
+    if '--trace' in argv or os.environ.get('X10_TRACE'):
+        if '--trace' in argv:
+            argv.remove('--trace')
+        trace_enabled = True
+    use_mochad_events = True
+    if '--no-mochad-events' in argv:
+        argv.remove('--no-mochad-events')
+        use_mochad_events = False
+    use_command_queue = True
+    if '--sync' in argv:
+        argv.remove('--sync')
+        use_command_queue = False
+    routes = None
+    if config.get('controllers'):
+        routes = make_routes(config['controllers'], log)
+        if breaker_failures:
+            routes = add_circuit_breakers(routes, failure_threshold=breaker_failures, reset_timeout=breaker_reset,
+                                          call_timeout=driver_timeout, log=log)
+        x10device = RoutingDriver(routes)
+        if use_mochad_events:
+            for controller_config in config['controllers']:
+                if controller_config.get('type') == 'mochad':
+                    MochadEventReader((controller_config.get('host', mochad_host), int(controller_config.get('port', mochad_port))), x10_state, pending=command_pending, log=log).start()
+    elif simulate:
+        import x10_sim  # only needed for simulation
+        log.info('using simulated controller %s', simulate)
+        x10device = x10_sim.parse_simulate_option(simulate)
+    elif '-m' in argv:
         argv.remove('-m')
-        log.info('using Mochad')
-        #x10device = x10_any.MochadDriver()  # TODO config
-        x10device = x10_any.MochadDriver((mochad_host, mochad_port))
+        log.info('using Mochad %s:%d type %s', mochad_host, mochad_port, mochad_type)
+        x10device = PersistentMochadDriver((mochad_host, mochad_port), mochad_type, timeout=mochad_timeout, log=log)
+        if use_mochad_events:
+            MochadEventReader((mochad_host, mochad_port), x10_state, pending=command_pending, log=log).start()
     else:
         try:
             serial_port_name = argv[1]
@@ -254,11 +2800,82 @@ def main(argv=None):
             serial_port_name = os.environ.get('X10_SERIAL_PORT')
             if serial_port_name:
                 log.info('Serial port picked up from env X10_SERIAL_PORT')
-        x10device = x10_any.FirecrackerDriver(serial_port_name)
+        x10device = LazyDriver(lambda: x10_any.FirecrackerDriver(serial_port_name), serial_port_name, log=log)
         log.info('Using serial port %r', serial_port_name)
 
-    httpd = make_server('', http_server_port, simple_app, server_class=MyWSGIServer, handler_class=MyWSGIRequestHandler)
-    log.info('Serving on http://%s:%d/' % (platform.node(), http_server_port))
+    if breaker_failures and not routes:
+        x10device = CircuitBreaker(x10device, failure_threshold=breaker_failures, reset_timeout=breaker_reset,
+                                   call_timeout=driver_timeout, log=log)
+    if breaker_failures:
+        log.info('Controller marked down after %d failures (or %r sec timeouts), retried every %r secs',
+                 breaker_failures, driver_timeout, breaker_reset)
+
+    if state_filename:
+        journal = StateJournal(state_filename, log=log)
+        journal.load(x10_state)
+        journal.start(x10_state)
+
+    if config.get('scenes'):
+        load_scenes(config['scenes'], log)
+    if '--remote' in argv or os.environ.get('X10_REMOTE'):
+        if '--remote' in argv:
+            argv.remove('--remote')
+        mount_remote(log)
+
+    deadlines = {}
+    for priority_name, deadline in config.get('deadlines', {}).items():
+        deadlines[priority_names[priority_name]] = float(deadline)
+    if use_command_queue:
+        if routes:
+            command_queue = ShardedCommandQueue(routes, coalesce_window=coalesce_window, deadlines=deadlines, log=log,
+                                                state_table=x10_state)
+        else:
+            command_queue = CommandQueue(x10device, x10device_lock, coalesce_window=coalesce_window, deadlines=deadlines, log=log,
+                                         state_table=x10_state)
+        log.info('Using transmit queue, coalesce window %r seconds', coalesce_window)
+        metrics.append(Gauge('x10_command_queue_depth', 'Commands waiting to be sent', lambda: len(command_queue)))
+        metrics.append(Gauge('x10_commands_coalesced', 'Commands replaced before being sent', lambda: command_queue.coalesced_count))
+        effective_deadlines = dict(default_deadlines)
+        effective_deadlines.update(deadlines)
+        log.info('Command deadlines (secs) %r', dict((priority_labels[priority], deadline) for priority, deadline in effective_deadlines.items()))
+    else:
+        log.info('Sending commands synchronously')
+    if command_queue is None:
+        max_outstanding = None  # requests wait for the send, the worker pool is the limit
+    if client_rate or max_outstanding:
+        admission = AdmissionControl(client_rate, client_burst, max_outstanding,
+                                     outstanding=lambda: len(command_queue), log=log)
+        log.info('Admission control, %r commands/sec per client (burst %d), max %r queued commands',
+                 client_rate, client_burst, max_outstanding)
+
+    listen_socket = inherited_socket()
+    if listen_socket is not None:
+        log.info('Using socket from systemd socket activation')
+    if owner_socket:
+        owner_server = OwnerServer(owner_socket)
+        log.info('Driver owner, accepting commands from worker processes on %r', owner_socket)
+        if not serve_http:
+            log.info('CTRL-C (or CTRL-Break) to quit')
+            owner_server.serve_forever()
+            return 0
+        owner_thread = threading.Thread(target=owner_server.serve_forever, name='x10-owner')
+        owner_thread.daemon = True
+        owner_thread.start()
+
+    app = application
+    if trace_enabled:
+        log.info('Logging request timing traces')
+        app = trace_middleware(application, log)
+    httpd = make_x10_server('', http_server_port, app, worker_count=worker_count,
+                            keep_alive_timeout=keep_alive_timeout, max_keep_alive_requests=max_keep_alive_requests,
+                            listen_socket=listen_socket)
+    log.info('Using %d worker threads', worker_count)
+    if worker_count:
+        metrics.append(Gauge('x10_http_requests_waiting', 'HTTP connections waiting for a worker thread', httpd.request_queue.qsize))
+        if keep_alive_timeout:
+            log.info('Persistent connections, idle timeout %r seconds, max %d requests', keep_alive_timeout, max_keep_alive_requests)
+            metrics.append(Gauge('x10_http_idle_connections', 'Persistent connections waiting for next request', lambda: len(httpd.idle_connections)))
+    log.info('Serving on http://%s:%d/' % (platform.node(), httpd.server_port))
     log.info('CTRL-C (or CTRL-Break) to quit')
     httpd.serve_forever()
     return 0
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Simulated X10 controller, no hardware needed.
+Python 2 or Python 3
+
+Behaves like x10_any.FirecrackerDriver and x10_any.MochadDriver as far as
+timing goes, x10_command() blocks for roughly as long as the real
+controller would take to transmit. Used to tune/profile x10_rest on any
+machine, see `x10_rest.py --simulate PROFILE`.
+
+Profiles:
+
+  * firecracker - CM17A serial Firecracker (x10_any.cm17a), each command is
+    a single RF packet bit-banged over RTS/DTR with 0.5 sec lead in and
+    lead out, about 1.08 secs. Port is opened for each command.
+  * rf - Mochad with CM15A/CM19A RF ('rf' mochad_type), one packet per
+    command, repeated by the controller, about 0.45 secs.
+  * pl - Mochad with CM15A powerline ('pl' mochad_type). Synchronized to
+    mains zero crossings, an address frame and then a function frame, each
+    sent twice plus gap (25 cycles, about 0.42 secs at 60Hz). The address
+    frame is skipped if the unit was the last one addressed, whole house
+    commands are a function frame only.
+
+Timing values are approximations from the protocol descriptions, not
+measurements of any particular unit.
+
+Failures and stalls can be injected, e.g. to exercise retries and queueing:
+
+    SimulatedDriver('pl', failure_rate=0.05, stall_rate=0.01, stall_time=30)
+"""
+
+import logging
+import random
+import threading
+import time
+
+import x10_any
+
+
+default_logger = logging.getLogger(__name__)
+
+
+def powerline_frame_time(mains_frequency=60):
+    """Seconds for one X10 powerline frame; 11 cycles sent twice plus 3 cycle gap"""
+    return 25.0 / mains_frequency
+
+
+profiles = {
+    # seconds
+    'firecracker': {'open_time': 0.02, 'address_time': 0.0, 'function_time': 1.08},
+    'rf': {'open_time': 0.001, 'address_time': 0.0, 'function_time': 0.45},
+    'pl': {'open_time': 0.001, 'address_time': powerline_frame_time(), 'function_time': powerline_frame_time()},
+}
+
+
+class SimulatedFailure(x10_any.X10BaseException):
+    '''Injected failure from SimulatedDriver'''
+
+
+class SimulatedDriver(x10_any.X10Driver):
+    """X10 command driver that sends nothing, but takes as long as a real
+    controller would. See module docstring for profiles.
+
+    All times are divided by speedup, e.g. speedup=10 for quicker runs.
+    Commands sent are recorded in self.sent as (house_code, unit_number, state).
+    """
+
+    def __init__(self, device_address='pl', failure_rate=0.0, stall_rate=0.0, stall_time=30.0,
+                 speedup=1.0, seed=None, log=None):
+        """
+        @param device_address - profile name, see profiles
+        @param failure_rate - probability (0.0-1.0) a command raises SimulatedFailure
+        @param stall_rate - probability a command blocks for stall_time seconds
+            before completing (e.g. hung serial port or mochad)
+        """
+        try:
+            profile = profiles[device_address]
+        except KeyError:
+            raise x10_any.X10BaseException('unknown simulated controller %r, expected one of %r' % (device_address, sorted(profiles)))
+        self.device_address = device_address
+        self.open_time = profile['open_time']
+        self.address_time = profile['address_time']
+        self.function_time = profile['function_time']
+        self.failure_rate = failure_rate
+        self.stall_rate = stall_rate
+        self.stall_time = stall_time
+        self.speedup = speedup
+        self.random = random.Random(seed)
+        self.log = log or default_logger
+        self.lock = threading.Lock()  # one transmission at a time, like the real thing
+        self.last_address = None
+        self.sent = []
+
+    def command_time(self, house_code, unit_number):
+        """Seconds transmission takes, caller is expected to hold self.lock"""
+        duration = self.open_time + self.function_time
+        if unit_number is not None and (house_code, unit_number) != self.last_address:
+            duration += self.address_time
+        return duration
+
+    def _x10_command(self, house_code, unit_number, state):
+        """Real implementation"""
+        with self.lock:
+            duration = self.command_time(house_code, unit_number)
+            if unit_number is not None:
+                self.last_address = (house_code, unit_number)
+            if self.stall_rate and self.random.random() < self.stall_rate:
+                self.log.warning('simulated stall %r for %r secs', (house_code, unit_number, state), self.stall_time)
+                duration += self.stall_time
+            time.sleep(duration / self.speedup)
+            if self.failure_rate and self.random.random() < self.failure_rate:
+                self.last_address = None
+                raise SimulatedFailure('simulated failure %r' % ((house_code, unit_number, state),))
+            self.log.debug('simulated send %r took %r', (house_code, unit_number, state), duration)
+            self.sent.append((house_code, unit_number, state))
+
+
+def parse_simulate_option(option):
+    """Returns SimulatedDriver from command line option value
+    "PROFILE[,name=value...]", for example "pl,failure_rate=0.05,speedup=10"
+    """
+    option_parts = option.split(',')
+    kwargs = {}
+    for name_value in option_parts[1:]:
+        name, value = name_value.split('=', 1)
+        kwargs[name.strip()] = float(value)
+    return SimulatedDriver(option_parts[0], **kwargs)